@@ -0,0 +1,45 @@
+import asyncio
+import collections
+from aiohttp import web
+
+# Just enough of the last.fm API for the scrobbler: accepts track.scrobble and
+# track.updateNowPlaying after a fixed delay, standing in for network latency,
+# and counts what it received.
+class FakeLastFM:
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.requests: collections.Counter[str] = collections.Counter()
+        self.scrobbles: int = 0
+        self._runner: web.AppRunner
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        method = str(data.get("method", request.query.get("method", "")))
+        self.requests[method] += 1
+
+        await asyncio.sleep(self.latency)
+
+        if method == "track.scrobble":
+            accepted = sum(1 for key in data if key.startswith("track["))
+            self.scrobbles += accepted
+            return web.json_response({ "scrobbles": { "@attr": { "accepted": accepted, "ignored": 0 } } })
+
+        if method == "track.updateNowPlaying":
+            return web.json_response({ "nowplaying": {} })
+
+        return web.json_response({ "error": 3, "message": "Invalid Method" }, status=400)
+
+    async def start(self, host: str = "127.0.0.1") -> str:
+        app = web.Application()
+        app.router.add_route("*", "/2.0/", self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/2.0/"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
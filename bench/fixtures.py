@@ -0,0 +1,74 @@
+import os
+import pathlib
+import random
+import struct
+from xml.sax.saxutils import escape
+
+# Synthetic inputs for the benchmarks. Everything is generated from a seed so
+# runs are comparable.
+
+SAMPLE_RATE = 44100
+
+def flac(path: str, title: str, artist: str, album: str, duration: float) -> None:
+    # A FLAC file with a STREAMINFO and VORBIS_COMMENT block and no audio, which
+    # is all a tag reader looks at. Tiny, but parsed the same way as a real one.
+    samples = int(duration * SAMPLE_RATE)
+
+    streaminfo = struct.pack(">HH", 4096, 4096) + b"\0" * 6
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits samples
+    packed = (SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) | samples
+    streaminfo += packed.to_bytes(8, "big") + b"\0" * 16
+
+    vendor = b"bench"
+    comments = [ f"TITLE={title}", f"ARTIST={artist}", f"ALBUM={album}", f"ALBUMARTIST={artist}" ]
+    vorbis = struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(comments))
+    for comment in comments:
+        encoded = comment.encode("utf-8")
+        vorbis += struct.pack("<I", len(encoded)) + encoded
+
+    with open(path, "wb") as file:
+        file.write(b"fLaC")
+        file.write(bytes([ 0 ]) + len(streaminfo).to_bytes(3, "big") + streaminfo)
+        file.write(bytes([ 0x80 | 4 ]) + len(vorbis).to_bytes(3, "big") + vorbis)
+
+def audio_tree(directory: str, artists: int, albums_per_artist: int, tracks_per_album: int, seed: int = 0) -> list[str]:
+    # Artist/Album/NN Title.flac, like a typical collection folder
+    rng = random.Random(seed)
+    tracks: list[str] = []
+
+    for artist in range(artists):
+        for album in range(albums_per_artist):
+            album_dir = os.path.join(directory, f"Artist {artist}", f"Album {artist}-{album}")
+            os.makedirs(album_dir, exist_ok=True)
+
+            for number in range(tracks_per_album):
+                title = f"Track {artist}-{album}-{number}"
+                path = os.path.join(album_dir, f"{number + 1:02} {title}.flac")
+                flac(path, title, f"Artist {artist}", f"Album {artist}-{album}", rng.uniform(90, 420))
+                tracks.append(path)
+
+    return tracks
+
+def xspf(path: str, title: str, tracks: list[str]) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+        file.write("<playlist version=\"1\" xmlns=\"http://xspf.org/ns/0/\">\n")
+        file.write(f"  <title>{escape(title)}</title>\n")
+        file.write("  <trackList>\n")
+
+        for track in tracks:
+            name = os.path.splitext(os.path.basename(track))[0]
+            file.write("    <track>\n")
+            file.write(f"      <location>{escape(pathlib.Path(track).as_uri())}</location>\n")
+            file.write(f"      <title>{escape(name)}</title>\n")
+            file.write("    </track>\n")
+
+        file.write("  </trackList>\n")
+        file.write("</playlist>\n")
+
+def xspf_directory(directory: str, tracks: list[str], playlists: int, tracks_per_playlist: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    for i in range(playlists):
+        xspf(os.path.join(directory, f"Playlist {i}.xspf"), f"Playlist {i}", rng.choices(tracks, k=tracks_per_playlist))
@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+import fake_lastfm
+import fixtures
+import strawberry_db as strawberry_fixture
+
+from metadata import Metadata, MetadataStore
+from playlists import SearchPaths, collection, xspf
+from scrobbler import ScrobbleDispatcher
+import lastfm
+import playlists
+
+# Benchmarks playlist loading, metadata reads and the scrobble queue against
+# generated fixtures and writes the results as JSON.
+#
+#   python bench/run.py [--output results.json] [--baseline previous.json]
+#
+# Sizes come from BENCH_* environment variables so runs on different machines
+# can be made comparable. With --baseline every timing is compared against an
+# earlier run and the exit code is 1 if anything got slower than --tolerance.
+
+# Seconds, anything closer than this to the baseline is never a regression
+MIN_REGRESSION = 0.005
+
+def _env(name: str, default: float) -> float:
+    return type(default)(os.environ.get(name, default))
+
+PARAMETERS = {
+    "artists": _env("BENCH_ARTISTS", 50),
+    "albums_per_artist": _env("BENCH_ALBUMS_PER_ARTIST", 4),
+    "tracks_per_album": _env("BENCH_TRACKS_PER_ALBUM", 12),
+    "strawberry_songs": _env("BENCH_SONGS", 100_000),
+    "strawberry_playlists": _env("BENCH_PLAYLISTS", 1_000),
+    "strawberry_items_per_playlist": _env("BENCH_ITEMS_PER_PLAYLIST", 200),
+    "xspf_playlists": _env("BENCH_XSPF_PLAYLISTS", 20),
+    "xspf_tracks_per_playlist": _env("BENCH_XSPF_TRACKS", 5_000),
+    "metadata_lookups": _env("BENCH_METADATA_LOOKUPS", 2_000),
+    "scrobble_users": _env("BENCH_SCROBBLE_USERS", 20),
+    "scrobbles": _env("BENCH_SCROBBLES", 5_000),
+    "scrobble_concurrency": _env("BENCH_SCROBBLE_CONCURRENCY", 4),
+    # High enough that the rate limiter isn't what's being measured
+    "scrobble_rate": _env("BENCH_SCROBBLE_RATE", 1000.0),
+    "lastfm_latency": _env("BENCH_LASTFM_LATENCY", 0.05),
+    "repeat": _env("BENCH_REPEAT", 3)
+}
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+async def _timed_async(awaitable):
+    start = time.perf_counter()
+    result = await awaitable
+    return time.perf_counter() - start, result
+
+def _best(func, *args, setup=None) -> tuple[float, object]:
+    # Best of `repeat` runs, the least noisy number for comparing runs
+    times: list[float] = []
+    result = None
+    for _ in range(PARAMETERS["repeat"]):
+        if setup is not None:
+            setup()
+        duration, result = _timed(func, *args)
+        times.append(duration)
+    return min(times), result
+
+def _count_tracks(loaded: list) -> int:
+    return sum(len(playlist.tracks) for playlist in loaded)
+
+def bench_playlists(directory: str, tracks: list[str]) -> dict:
+    db_path = os.path.join(directory, "strawberry.db")
+    xspf_path = os.path.join(directory, "xspf")
+    collection_path = os.path.join(directory, "music")
+    snapshot_path = os.path.join(directory, "collection_snapshot.json")
+    missing = os.path.join(directory, "missing.db")
+
+    strawberry_fixture.generate(db_path, PARAMETERS["strawberry_songs"], PARAMETERS["strawberry_playlists"], PARAMETERS["strawberry_items_per_playlist"])
+    fixtures.xspf_directory(xspf_path, tracks, PARAMETERS["xspf_playlists"], PARAMETERS["xspf_tracks_per_playlist"])
+
+    results: dict = {}
+
+    paths = SearchPaths(strawberry_db=db_path)
+    duration, loaded = _best(playlists.parse_all_playlists, paths)
+    results["strawberry_db"] = { "seconds": duration, "playlists": len(loaded), "tracks": _count_tracks(loaded) }
+
+    # Cold is a fresh process, warm is a reload where nothing changed
+    paths = SearchPaths(strawberry_db=missing, xspf_path=xspf_path)
+    cold, loaded = _best(playlists.parse_all_playlists, paths, setup=xspf._cache.clear)
+    warm, _ = _best(playlists.parse_all_playlists, paths)
+    results["xspf"] = { "cold_seconds": cold, "warm_seconds": warm, "playlists": len(loaded), "tracks": _count_tracks(loaded) }
+
+    # From scratch, from the snapshot a previous run left behind, and a rescan
+    # in the same process
+    def forget_everything():
+        collection._scanners.clear()
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+    paths = SearchPaths(strawberry_db=missing, collection_path=collection_path, collection_snapshot=snapshot_path)
+    cold, loaded = _best(playlists.parse_all_playlists, paths, setup=forget_everything)
+    snapshot, _ = _best(playlists.parse_all_playlists, paths, setup=collection._scanners.clear)
+    warm, _ = _best(playlists.parse_all_playlists, paths)
+    results["collection"] = { "cold_seconds": cold, "snapshot_seconds": snapshot, "warm_seconds": warm, "tracks": _count_tracks(loaded) }
+
+    paths = SearchPaths(strawberry_db=db_path, xspf_path=xspf_path, collection_path=collection_path, collection_snapshot=snapshot_path)
+    duration, _ = _best(playlists.parse_all_playlists, paths)
+    results["all"] = { "seconds": duration }
+
+    async def load_parallel():
+        return await playlists.load_all_sources(paths)
+
+    duration, _ = _best(lambda: asyncio.run(load_parallel()))
+    results["all_parallel"] = { "seconds": duration }
+
+    return results
+
+async def bench_metadata(directory: str, tracks: list[str]) -> dict:
+    results: dict = {}
+    sample = random.Random(0).choices(tracks, k=PARAMETERS["metadata_lookups"])
+
+    # Nothing indexed yet, every lookup reads tags from the file
+    store = MetadataStore(os.path.join(directory, "metadata_cold.db"))
+    start = time.perf_counter()
+    for track in tracks:
+        await store.get(track)
+    duration = time.perf_counter() - start
+    results["cold_get"] = { "seconds": duration, "per_second": len(tracks) / duration }
+    store.close()
+
+    store = MetadataStore(os.path.join(directory, "metadata_fill.db"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        await store.fill(tracks)
+        duration = time.perf_counter() - start
+    results["fill"] = { "seconds": duration, "per_second": len(tracks) / duration }
+
+    # The process pool the bulk extraction command uses
+    extract_store = MetadataStore(os.path.join(directory, "metadata_extract.db"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        duration, _ = _timed(extract_store.extract, tracks)
+    results["extract"] = { "seconds": duration, "per_second": len(tracks) / duration }
+    extract_store.close()
+
+    # Everything indexed, what a lookup for the next track costs during playback
+    start = time.perf_counter()
+    for track in sample:
+        await store.get(track)
+    duration = time.perf_counter() - start
+    results["warm_get"] = { "seconds": duration, "per_second": len(sample) / duration }
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ store.get(track) for track in sample ])
+    duration = time.perf_counter() - start
+    results["warm_get_concurrent"] = { "seconds": duration, "per_second": len(sample) / duration }
+
+    duration, everything = await _timed_async(store.all())
+    results["all"] = { "seconds": duration, "tracks": len(everything) }
+
+    store.close()
+    return results
+
+async def bench_scrobbles(directory: str) -> dict:
+    server = fake_lastfm.FakeLastFM(PARAMETERS["lastfm_latency"])
+    lastfm.LastFM.API_ROOT = await server.start()
+
+    lfm = lastfm.LastFM("key", "secret")
+    lfm.init_session()
+
+    lfmsm = lastfm.LastFMSessionManager(os.path.join(directory, "sessions.db"))
+    users = [ str(i) for i in range(PARAMETERS["scrobble_users"]) ]
+    for user in users:
+        lfmsm.add_session(user, (f"user{user}", f"session{user}"))
+
+    dispatcher = ScrobbleDispatcher(
+        lfm, lfmsm,
+        os.path.join(directory, "scrobbles.db"),
+        PARAMETERS["scrobble_concurrency"],
+        PARAMETERS["scrobble_rate"]
+    )
+
+    count = PARAMETERS["scrobbles"]
+    metadata = Metadata("Title", "Artist", "Album", None, 200)
+    now = int(time.time())
+
+    results: dict = {}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Queueing only, nothing is sent until the dispatcher runs
+        start = time.perf_counter()
+        for i in range(count):
+            dispatcher.scrobble(users[i % len(users)], metadata, now - i)
+        while dispatcher.pending < count:
+            await asyncio.sleep(0.001)
+        duration = time.perf_counter() - start
+        results["enqueue"] = { "seconds": duration, "per_second": count / duration }
+
+        start = time.perf_counter()
+        task = asyncio.create_task(dispatcher.run())
+        while dispatcher.pending > 0:
+            await asyncio.sleep(0.001)
+        duration = time.perf_counter() - start
+        task.cancel()
+
+    results["drain"] = {
+        "seconds": duration,
+        "per_second": count / duration,
+        "requests": server.requests["track.scrobble"],
+        "accepted": server.scrobbles
+    }
+
+    await lfm._session.close()
+    await server.stop()
+    lfmsm.close()
+    return results
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        commit = ""
+
+    return {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count()
+    }
+
+def _timings(results: dict, prefix: str = "") -> dict[str, float]:
+    # Flattens to "section.name.seconds" -> value for every timing
+    timings: dict[str, float] = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            timings |= _timings(value, f"{name}.")
+        elif key.endswith("seconds"):
+            timings[name] = value
+    return timings
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    # Prints how every timing changed, returns whether none got slower than
+    # `tolerance` (0.2 is 20% slower)
+    current = _timings(results["results"])
+    previous = _timings(baseline["results"])
+
+    ok = True
+    print(f"\nCompared to {baseline['environment'].get('commit', '')[:12] or 'baseline'}:")
+    for name, value in current.items():
+        if name not in previous or previous[name] == 0:
+            continue
+
+        # Differences of a few milliseconds are noise, not regressions
+        change = value / previous[name] - 1
+        regressed = change > tolerance and value - previous[name] > MIN_REGRESSION
+        ok = ok and not regressed
+        print(f"  {'!' if regressed else ' '} {name}: {previous[name]:.4f}s -> {value:.4f}s ({change:+.0%})")
+
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark playlist loading, metadata and scrobbling")
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much slower a timing can get before it counts as a regression")
+    args = parser.parse_args()
+
+    results: dict = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        music = os.path.join(directory, "music")
+        print(f"Generating fixtures in {directory}")
+        tracks = fixtures.audio_tree(music, PARAMETERS["artists"], PARAMETERS["albums_per_artist"], PARAMETERS["tracks_per_album"])
+
+        print("Benchmarking playlist loading")
+        results["playlists"] = bench_playlists(directory, tracks)
+
+        print("Benchmarking metadata")
+        results["metadata"] = asyncio.run(bench_metadata(directory, tracks))
+
+        print("Benchmarking scrobbles")
+        results["scrobbles"] = asyncio.run(bench_scrobbles(directory))
+
+    output = { "environment": _environment(), "parameters": PARAMETERS, "results": results }
+
+    for name, value in _timings(results).items():
+        print(f"  {name}: {value:.4f}s")
+
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "rb") as file:
+            baseline = json.load(file)
+        if not compare(output, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+from playlists import strawberry_db
+
+# The parts of Strawberry's schema the bot reads from
+SCHEMA = """
+    CREATE TABLE songs (
+        title TEXT NOT NULL DEFAULT '',
+        album TEXT NOT NULL DEFAULT '',
+        artist TEXT NOT NULL DEFAULT '',
+        albumartist TEXT NOT NULL DEFAULT '',
+        url TEXT NOT NULL,
+        playcount INTEGER NOT NULL DEFAULT 0,
+        rating REAL NOT NULL DEFAULT -1
+    );
+    CREATE TABLE playlists (
+        name TEXT NOT NULL,
+        last_played INTEGER NOT NULL DEFAULT -1
+    );
+    CREATE TABLE playlist_items (
+        playlist INTEGER NOT NULL,
+        type INTEGER NOT NULL DEFAULT 2,
+        collection_id INTEGER,
+        url TEXT
+    );
+    CREATE INDEX idx_playlist_items_playlist ON playlist_items (playlist);
+"""
+
+def generate(path: str, songs: int, playlists: int, items_per_playlist: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    c = sqlite3.connect(path)
+    c.executescript(SCHEMA)
+
+    c.executemany("INSERT INTO songs (title, album, artist, albumartist, url, playcount, rating) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+        (
+            f"Track {i}",
+            f"Album {i // 12}",
+            f"Artist {i // 120}",
+            f"Artist {i // 120}",
+            "file://" + urllib.parse.quote(f"/music/Artist {i // 120}/Album {i // 12}/{i % 12:02} Track {i}.flac"),
+            rng.randrange(100),
+            rng.choice([-1, 0.2, 0.4, 0.6, 0.8, 1.0])
+        )
+        for i in range(songs)
+    ))
+
+    c.executemany("INSERT INTO playlists (name) VALUES (?)", ((f"Playlist {i}", ) for i in range(playlists)))
+
+    c.executemany("INSERT INTO playlist_items (playlist, collection_id) VALUES (?, ?)", (
+        (playlist + 1, rng.randrange(songs) + 1)
+        for playlist in range(playlists)
+        for _ in range(items_per_playlist)
+    ))
+
+    c.commit()
+    c.close()
+
+def parse_per_playlist(path: str) -> list[list[str]]:
+    # The importer this replaced, one query per playlist, kept for comparison
+    c = sqlite3.connect(path)
+    playlists: list[list[str]] = []
+    for playlist_rowid, _ in c.execute("SELECT ROWID, name FROM playlists").fetchall():
+        query = "SELECT url FROM songs WHERE ROWID IN (SELECT collection_id FROM playlist_items WHERE playlist = ?)"
+        playlists.append([
+            urllib.parse.unquote(urllib.parse.urlparse(url).path)
+            for url, *_ in c.execute(query, (playlist_rowid, ))
+        ])
+    c.close()
+    return playlists
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def main():
+    songs = int(os.environ.get("BENCH_SONGS", 100_000))
+    playlists = int(os.environ.get("BENCH_PLAYLISTS", 1_000))
+    items = int(os.environ.get("BENCH_ITEMS_PER_PLAYLIST", 200))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "strawberry.db")
+        print(f"Generating {songs} songs, {playlists} playlists with {items} items each")
+        generate(path, songs, playlists, items)
+
+        print(f"per-playlist queries: {timed(parse_per_playlist, path):.3f}s")
+        print(f"single query:         {timed(strawberry_db.parse, path):.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
-from . import current, lastfm, playlists
+from . import current, lastfm, playlists, search, stats
 
 GROUPS = [ current.GROUP, lastfm.GROUP, playlists.GROUP ]
+COMMANDS = [ search.COMMAND, stats.COMMAND ]
@@ -1,22 +1,69 @@
 from commands.common import bot
 from config import *
+from player import Player
+import asyncio
 import discord
+import music_bot
+import os
+
+# Room for the rest of the upload request besides the file itself
+UPLOAD_OVERHEAD = 64 * 1024
+# Copies made to fit the upload limit use a multiple of this bitrate so
+# guilds with similar limits share them
+DOWNLOAD_BITRATE_STEP = 16
+MIN_DOWNLOAD_BITRATE = 32
 
 GROUP = discord.app_commands.Group(name="current", description="Currently playing music commands")
 
 @GROUP.command(name="stop", description="Stop")
+@discord.app_commands.guild_only()
 async def current_stop(interaction: discord.Interaction):
-    await bot(interaction).stop()
+    assert interaction.guild is not None
+    await bot(interaction).player(interaction.guild).stop()
     await interaction.response.send_message("Bye")
 
 @GROUP.command(name="skip", description="Skip to the next track")
+@discord.app_commands.guild_only()
 async def current_skip(interaction: discord.Interaction):
-    bot(interaction).skip()
+    assert interaction.guild is not None
+    bot(interaction).player(interaction.guild).skip()
     await interaction.response.send_message("Skipped")
 
+async def find_download(client: music_bot.MusicBot, track: str, limit: int) -> (str | None):
+    # The track itself if it fits, otherwise an Opus copy that does, or None
+    if await asyncio.to_thread(os.path.getsize, track) <= limit:
+        return track
+
+    if client.transcodes is not None:
+        # With loudness normalization on, what playback cached is the
+        # normalized copy
+        cached = await client.transcodes.lookup(track, await client.get_gain(track))
+        if cached is not None and await asyncio.to_thread(os.path.getsize, cached) <= limit:
+            return cached
+
+    if client.downloads is None:
+        return None
+
+    metadata = await client.get_metadata(track)
+    if metadata is None or metadata.duration <= 0:
+        return None
+
+    bitrate = int(limit * 8 / metadata.duration / 1000) // DOWNLOAD_BITRATE_STEP * DOWNLOAD_BITRATE_STEP
+    bitrate = min(Player.BITRATE, bitrate)
+    if bitrate < MIN_DOWNLOAD_BITRATE:
+        return None
+
+    path = await client.downloads.get(track, bitrate)
+    if path is None or await asyncio.to_thread(os.path.getsize, path) > limit:
+        return None
+
+    return path
+
 @GROUP.command(name="download", description="Send file of currently playing song")
+@discord.app_commands.guild_only()
 async def current_download(interaction: discord.Interaction):
-    track = bot(interaction).track
+    assert interaction.guild is not None
+    track = bot(interaction).player(interaction.guild).track
 
     if track is None:
         await interaction.response.send_message(f"Nothing has been played yet")
@@ -25,6 +72,20 @@ async def current_download(interaction: discord.Interaction):
     await interaction.response.defer()
 
     try:
-        await interaction.followup.send(file=discord.File(track))
+        path = await find_download(bot(interaction), track, interaction.guild.filesize_limit - UPLOAD_OVERHEAD)
+        if path is None:
+            await interaction.followup.send(f"This track is too big to upload here (the limit is {interaction.guild.filesize_limit / 1024 ** 2:.0f} MiB)")
+            return
+
+        filename = os.path.basename(track)
+        if path != track:
+            filename = os.path.splitext(filename)[0] + ".ogg"
+
+        # Sent from the open file, it's never read into memory as a whole
+        file = await asyncio.to_thread(open, path, "rb")
+        try:
+            await interaction.followup.send(file=discord.File(file, filename=filename))
+        finally:
+            file.close()
     except Exception as e:
         await interaction.followup.send(f"Couldn't send file: `{e}`")
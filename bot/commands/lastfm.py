@@ -30,11 +30,13 @@ async def lastfm_link(interaction: discord.Interaction):
 
     name, key = session
     bot(interaction).lfmsm.add_session(str(interaction.user.id), (name, key))
+    bot(interaction).session_changed(interaction.user.id)
     await interaction.edit_original_response(content=f"Successfully authenticated as {name}")
 
 @GROUP.command(name="unlink", description="Unlink your last.fm account from the bot")
 async def lastfm_unlink(interaction: discord.Interaction):
     bot(interaction).lfmsm.remove_session(str(interaction.user.id))
+    bot(interaction).session_changed(interaction.user.id)
     await interaction.response.send_message(f"Your last.fm account was disconnected")
 
 @GROUP.command(name="info", description="Show what last.fm account is linked")
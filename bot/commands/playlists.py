@@ -1,20 +1,35 @@
 from commands.common import bot
-from config import *
+from settings import *
 import discord
+import music_bot
+import selection
 
 GROUP = discord.app_commands.Group(name="playlists", description="Playlist related commands")
 
 @GROUP.command(name="reload", description=f"Reload all playlists")
 async def playlists_reload(interaction: discord.Interaction):
+    if bot(interaction).loading:
+        await interaction.response.send_message(f"Playlists are still being loaded, try again in a moment")
+        return
+
     await interaction.response.send_message(f"Reloading playlists...")
-    bot(interaction).reload_playlists()
-    await interaction.edit_original_response(content=f"Reloaded playlists")
+    results = await bot(interaction).reload_playlists()
+
+    lines = [ f"Reloaded {len(bot(interaction).playlists)} playlist(s)" ]
+    for result in results:
+        if result.error is not None:
+            lines.append(f"- `{result.source}`: failed after {result.duration:.2f}s: `{result.error}`")
+        else:
+            tracks = sum(len(playlist.tracks) for playlist in result.playlists)
+            lines.append(f"- `{result.source}`: {len(result.playlists)} playlist(s), {tracks} track(s) in {result.duration:.2f}s")
+
+    await interaction.edit_original_response(content="\n".join(lines))
 
 @GROUP.command(name="list", description="List available playlists")
 async def playlists_list(interaction: discord.Interaction):
     embed = discord.Embed(
         title="Playlists",
-        description=f"Have {len(bot(interaction).playlists)} playlist(s)"
+        description=f"Have {len(bot(interaction).playlists)} playlist(s)" + (", still loading" if bot(interaction).loading else "")
     )
 
     for playlist in bot(interaction).playlists:
@@ -27,16 +42,29 @@ async def playlists_list(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed)
 
 async def autocomplete_playlist(interaction: discord.Interaction, current: str) -> list[discord.app_commands.Choice[str]]:
+    if len(current) == 0:
+        playlists = bot(interaction).playlists[:25]
+    else:
+        playlists = [
+            playlist for playlist in (
+                bot(interaction).find_playlist_by_name(entry.key)
+                for entry in bot(interaction).playlist_index.search(current)
+            )
+            if playlist is not None
+        ]
+
     return [
-        discord.app_commands.Choice(name=f"[{playlist.source}] {playlist.name}", value=playlist.name)
-        for playlist in bot(interaction).playlists if current.lower() in playlist.name.lower()
+        discord.app_commands.Choice(name=f"[{playlist.source}] {playlist.name}"[:100], value=music_bot.MusicBot.playlist_key(playlist.name))
+        for playlist in playlists
     ]
 
 @GROUP.command(name="play", description="Play a playlist")
 @discord.app_commands.autocomplete(playlist_name=autocomplete_playlist)
 @discord.app_commands.rename(playlist_name="playlist")
+@discord.app_commands.describe(mode="How tracks are picked")
+@discord.app_commands.choices(mode=[ discord.app_commands.Choice(name=mode, value=mode) for mode in selection.MODES ])
 @discord.app_commands.guild_only()
-async def playlists_play(interaction: discord.Interaction, playlist_name: str):
+async def playlists_play(interaction: discord.Interaction, playlist_name: str, mode: (str | None) = None):
     assert interaction.guild is not None
     assert isinstance(interaction.user, discord.Member)
     assert isinstance(interaction.channel, discord.TextChannel)
@@ -47,11 +75,24 @@ async def playlists_play(interaction: discord.Interaction, playlist_name: str):
 
     assert isinstance(interaction.user.voice.channel, discord.VoiceChannel)
 
-    playlist = bot(interaction).find_playlist_by_name(playlist_name)
+    # A choice from autocomplete, or a name typed out in full
+    playlist = bot(interaction).find_playlist_by_key(playlist_name) or bot(interaction).find_playlist_by_name(playlist_name)
     if playlist is None:
+        if bot(interaction).loading:
+            await interaction.response.send_message(f"Playlists are still being loaded, try again in a moment")
+            return
+
         await interaction.response.send_message(f"Couldn't find playlist with name `{playlist_name}`")
         return
 
-    await bot(interaction).play(playlist, interaction.user.voice.channel, interaction.channel)
+    if len(playlist.tracks) == 0:
+        await interaction.response.send_message(f"Playlist `{playlist_name}` is empty")
+        return
+
+    selector = await bot(interaction).create_selector(playlist, SHUFFLE_MODE if mode is None else mode)
+    if not await bot(interaction).player(interaction.guild).play(selector, interaction.user.voice.channel, interaction.channel):
+        await interaction.response.send_message("Already playing in this server")
+        return
+
     await interaction.guild.change_voice_state(channel=interaction.user.voice.channel, self_deaf=True, self_mute=False)
     await interaction.response.send_message("Hi")
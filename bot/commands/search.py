@@ -0,0 +1,53 @@
+from commands.common import bot
+from config import *
+from playlists.common import TRACKS
+import discord
+
+# Autocomplete choices are the track's ID in TRACKS after this prefix, so
+# picking one queues exactly that track instead of searching for its name again
+CHOICE_PREFIX = "#"
+
+def find_choice(query: str) -> (str | None):
+    id = query[len(CHOICE_PREFIX):]
+    if not query.startswith(CHOICE_PREFIX) or not id.isdigit() or int(id) >= len(TRACKS):
+        return None
+    return TRACKS.path(int(id))
+
+async def autocomplete_track(interaction: discord.Interaction, current: str) -> list[discord.app_commands.Choice[str]]:
+    return [
+        discord.app_commands.Choice(name=entry.display[:100], value=f"{CHOICE_PREFIX}{TRACKS.intern(entry.key)}")
+        for entry in bot(interaction).track_index.search(current)
+    ]
+
+@discord.app_commands.command(name="search", description="Search for a track and queue it")
+@discord.app_commands.autocomplete(query=autocomplete_track)
+@discord.app_commands.guild_only()
+async def search(interaction: discord.Interaction, query: str):
+    assert interaction.guild is not None
+
+    player = bot(interaction).player(interaction.guild)
+    if not player.playing:
+        await interaction.response.send_message("Nothing is playing, start a playlist first")
+        return
+
+    track = find_choice(query)
+    if track is not None:
+        entry = bot(interaction).track_index.get(track)
+        player.enqueue(track)
+        await interaction.response.send_message(f"Queued {track if entry is None else entry.display} ({len(player.queue)} in queue)")
+        return
+
+    # Typed without picking a suggestion
+    results = bot(interaction).track_index.search(query, limit=1)
+    if len(results) == 0:
+        if bot(interaction).loading or bot(interaction).indexing:
+            await interaction.response.send_message(f"Tracks are still being indexed, try again in a moment")
+            return
+
+        await interaction.response.send_message(f"Couldn't find a track matching `{query}`")
+        return
+
+    player.enqueue(results[0].key)
+    await interaction.response.send_message(f"Queued {results[0].display} ({len(player.queue)} in queue)")
+
+COMMAND = search
@@ -0,0 +1,51 @@
+from commands.common import bot
+from config import *
+import discord
+import lastfm
+import metadata
+import music_bot
+import player
+import scrobbler
+
+def _ms(summary: (tuple[float, int] | None)) -> str:
+    if summary is None:
+        return "n/a"
+
+    mean, count = summary
+    return f"{mean * 1000:.1f}ms avg over {count:,}"
+
+@discord.app_commands.command(name="stats", description="Show playback and pipeline stats")
+async def stats(interaction: discord.Interaction):
+    b = bot(interaction)
+
+    embed = discord.Embed(title="Stats")
+
+    embed.add_field(name="Playback", value="\n".join([
+        f"**Active voice sessions**: {sum(1 for p in b.players.values() if p.playing)}",
+        f"**Inter-track gap**: {_ms(player.INTER_TRACK_GAP_SECONDS.summary())}",
+        f"**FFmpeg spawn**: {_ms(player.FFMPEG_SPAWN_SECONDS.summary('opus'))}",
+        f"**FFmpeg spawn (cached)**: {_ms(player.FFMPEG_SPAWN_SECONDS.summary('copy'))}",
+    ]), inline=False)
+
+    embed.add_field(name="Pipeline", value="\n".join([
+        f"**Event loop lag**: {music_bot.LOOP_LAG.values.get((), 0) * 1000:.1f}ms",
+        f"**Tag reads**: {_ms(metadata.TAG_READ_SECONDS.summary())}",
+        *[
+            f"**Reload `{source}`**: {_ms(music_bot.RELOAD_SECONDS.summary(source))}"
+            for source, in music_bot.RELOAD_SECONDS.values
+        ]
+    ]), inline=False)
+
+    embed.add_field(name="last.fm", value="\n".join([
+        f"**Pending scrobbles**: {b.scrobbles.pending:,}",
+        f"**Sent**: {int(scrobbler.SENT.values['scrobble',]):,} scrobble(s), {int(scrobbler.SENT.values['now_playing',]):,} now playing",
+        f"**Suppressed**: {sum(b.scrobbles.suppressed.values()):,}",
+        *[
+            f"**`{method}`**: {_ms(lastfm.REQUEST_SECONDS.summary(method))}"
+            for method, in lastfm.REQUEST_SECONDS.values
+        ]
+    ]), inline=False)
+
+    await interaction.response.send_message(embed=embed)
+
+COMMAND = stats
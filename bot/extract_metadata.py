@@ -0,0 +1,83 @@
+from playlists.collection import SUPPORTED_EXTENSIONS
+from settings import *
+import argparse
+import metadata
+import os
+import playlists
+import sys
+import time
+
+# Reads the tags of a whole library into the metadata store up front, across
+# all CPU cores, so the bot doesn't have to do it one track at a time. Safe to
+# stop and run again, it continues with whatever isn't in the store yet.
+#
+#   python extract_metadata.py [--workers N] [--chunk-size N] [directory ...]
+#
+# Without directories the tracks of every configured playlist source are used.
+
+def find_tracks(directories: list[str]) -> list[str]:
+    tracks: list[str] = []
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            tracks.extend(
+                os.path.join(root, file)
+                for file in files
+                if os.path.splitext(file)[1].lower() in SUPPORTED_EXTENSIONS
+            )
+    return tracks
+
+def configured_tracks() -> list[str]:
+    loaded = playlists.parse_all_playlists(playlists.SearchPaths(
+        xspf_path=PLAYLISTS_PATH,
+        collection_path=COLLECTION_PATH,
+        collection_snapshot=COLLECTION_SNAPSHOT_PATH
+    ))
+
+    ids: set[int] = set()
+    for playlist in loaded:
+        ids.update(playlist.tracks)
+    return [ playlists.TRACKS.path(id) for id in ids ]
+
+class ProgressReporter:
+    INTERVAL: float = 1
+
+    def __init__(self):
+        self._last: float = 0
+
+    def __call__(self, progress: metadata.ExtractProgress) -> None:
+        now = time.perf_counter()
+        if now - self._last < ProgressReporter.INTERVAL and progress.done < progress.total:
+            return
+        self._last = now
+
+        rate = progress.files_per_second
+        remaining = progress.total - progress.done
+        eta = f"{remaining / rate:.0f}s left" if rate > 0 else "estimating"
+        percent = progress.done / progress.total * 100 if progress.total > 0 else 100
+        print(f"{progress.done}/{progress.total} ({percent:.1f}%), {rate:.0f} files/s, {eta}", file=sys.stderr)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read tags for a whole library into the metadata store")
+    parser.add_argument("directories", nargs="*", help="Folders to index instead of the configured playlists")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to one per CPU")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Files per chunk, progress is saved after every chunk")
+    args = parser.parse_args()
+
+    print("Finding tracks")
+    tracks = find_tracks(args.directories) if len(args.directories) > 0 else configured_tracks()
+
+    store = metadata.MetadataStore(METADATA_DB_PATH)
+    try:
+        result = store.extract(tracks, args.workers, args.chunk_size, ProgressReporter())
+    except KeyboardInterrupt:
+        print("Interrupted, run again to continue where this left off")
+        sys.exit(1)
+    finally:
+        store.close()
+
+    elapsed = time.perf_counter() - result.started
+    print(f"Read {result.read} file(s) in {elapsed:.1f}s ({result.files_per_second:.0f} files/s), {result.skipped} already indexed")
+    if result.no_metadata > 0:
+        print(f"{result.no_metadata} file(s) had no usable metadata")
+    if result.failed > 0:
+        print(f"{result.failed} file(s) couldn't be read and will be tried again next run")
@@ -1,11 +1,20 @@
 import datetime
 from typing import Any
 import aiohttp
+import collections
+import concurrent.futures
 import hashlib
+import metrics
 import urllib.parse
 import os
 import json
 import dataclasses
+import sqlite3
+import threading
+import time
+
+REQUEST_SECONDS = metrics.Histogram("lastfm_request_seconds", "last.fm API call latency", ("method", ))
+REQUEST_ERRORS = metrics.Counter("lastfm_request_errors_total", "Failed last.fm API calls", ("method", "error"))
 
 @dataclasses.dataclass
 class LastFMUserInfo:
@@ -18,49 +27,120 @@ class LastFMUserInfo:
     registered: datetime.datetime
     url: str
 
+# Linked last.fm sessions, stored in SQLite.
+#
+# Nothing is loaded up front, sessions are read from the database the first
+# time they're asked for and remembered after that. Changes are applied in
+# memory right away and written to the database in batches on a worker
+# thread, each batch (removals included) in a single transaction.
 class LastFMSessionManager:
     def __init__(self, sessions_file: str):
         self.sessions_file = sessions_file
-        self._sessions: dict[str, tuple[str, str]] = {}
-
-        self._read()
-        print(f"Loaded {len(self._sessions)} last.fm sessions from {self.sessions_file}")
 
-    def _read(self) -> None:
-        if not os.path.exists(self.sessions_file):
+        # Older versions kept everything in a JSON file, that's imported once
+        legacy_file: (str | None) = None
+        if sessions_file.endswith(".json"):
+            legacy_file = sessions_file
+            self.sessions_file = os.path.splitext(sessions_file)[0] + ".db"
+
+        self._cache: dict[str, (tuple[str, str] | None)] = {}
+        self._pending: dict[str, (tuple[str, str] | None)] = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions")
+
+        self._connection = self._connect()
+        self._connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                key TEXT NOT NULL
+            );
+        """)
+        self._writer = self._connect(check_same_thread=False)
+
+        if legacy_file is not None and os.path.exists(legacy_file):
+            self._import(legacy_file)
+
+        print(f"Using last.fm sessions from {self.sessions_file}")
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        return sqlite3.connect(self.sessions_file, check_same_thread=check_same_thread)
+
+    def _import(self, legacy_file: str) -> None:
+        with open(legacy_file, "rb") as file:
+            sessions: dict[str, list[str]] = json.load(file)
+
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                ((user_id, name, key) for user_id, (name, key) in sessions.items())
+            )
+
+        os.replace(legacy_file, f"{legacy_file}.migrated")
+        print(f"Imported {len(sessions)} last.fm sessions from {legacy_file}")
+
+    def _flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if len(pending) == 0:
             return
 
-        with open(self.sessions_file, "rb") as file:
-            self._sessions = json.load(file)
-
-
-    def _write(self) -> None:
-        with open(self.sessions_file, "w") as file:
-            json.dump(self._sessions, file, default=lambda o: o.__dict__)
+        with self._writer:
+            self._writer.executemany(
+                "DELETE FROM sessions WHERE user_id = ?",
+                ((user_id, ) for user_id, session in pending.items() if session is None)
+            )
+            self._writer.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                ((user_id, *session) for user_id, session in pending.items() if session is not None)
+            )
+
+    def _write(self, user_id: str, session: (tuple[str, str] | None)) -> None:
+        self._cache[user_id] = session
+        with self._lock:
+            self._pending[user_id] = session
+        self._executor.submit(self._flush)
 
     def add_session(self, user_id: str, session: tuple[str, str]) -> None:
-        self._sessions[user_id] = session
-        self._write()
+        self._write(user_id, session)
 
     def get_session(self, user_id: str) -> (tuple[str, str] | None):
-        if user_id not in self._sessions:
-            return None
-        return self._sessions[user_id]
+        if user_id not in self._cache:
+            row = self._connection.execute("SELECT name, key FROM sessions WHERE user_id = ?", (user_id, )).fetchone()
+            self._cache[user_id] = None if row is None else (row[0], row[1])
+
+        return self._cache[user_id]
 
     def remove_session(self, user_id: str) -> None:
-        if user_id not in self._sessions:
+        if self.get_session(user_id) is None:
             return
 
-        del self._sessions[user_id]
+        self._write(user_id, None)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self._flush()
+        self._writer.close()
+        self._connection.close()
 
 class LastFM:
-    API_ROOT: str = "http://ws.audioscrobbler.com/2.0/"
+    API_ROOT: str = "https://ws.audioscrobbler.com/2.0/"
+    SCROBBLE_BATCH_SIZE: int = 50
+    CACHE_SIZE: int = 1024
+    USER_INFO_TTL: float = 5 * 60
 
-    def __init__(self, api_key: str, secret: str):
+    def __init__(self, api_key: str, secret: str, timeout: float = 10, connection_limit: int = 16):
         self.api_key = api_key
         self.secret = secret
+        self.timeout = timeout
+        self.connection_limit = connection_limit
         self._session: aiohttp.ClientSession
 
+        # (method, params) -> (expires at, response) for read-only methods
+        self._cache: collections.OrderedDict[tuple, tuple[float, Any]] = collections.OrderedDict()
+
     def _get_largest_image(self, image: list[dict[str, str]]) -> str:
         return image[len(image) - 1]["#text"]
 
@@ -75,7 +155,9 @@ class LastFM:
         hasher.update(params_full.encode("utf-8"))
         return hasher.hexdigest()
 
-    async def _get(self, method: str, sign: bool = False, params: dict[str, Any] = {}) -> Any:
+    def _prepare(self, method: str, sign: bool, params: (dict[str, Any] | None)) -> dict[str, Any]:
+        # Always a fresh dict, the caller's (or a shared default) is never modified
+        params = { key: value for key, value in (params or {}).items() if value is not None }
         params |= {
             "method": method,
             "api_key": self.api_key,
@@ -85,28 +167,63 @@ class LastFM:
         if sign:
             params["api_sig"] = self._sign(params)
 
-        async with self._session.get("", params=params) as response:
-            response.raise_for_status()
-            json = await response.json()
-            return json
-
-    async def _post(self, method: str, sign: bool = False, data: dict[str, Any] = {}) -> Any:
-        data |= {
-            "method": method,
-            "api_key": self.api_key,
-            "format": "json"
-        }
-
-        if sign:
-            data["api_sig"] = self._sign(data)
-
-        async with self._session.post("", data=data) as response:
-            response.raise_for_status()
-            json = await response.json()
-            return json
+        return params
+
+    def _timeout(self, total: float) -> aiohttp.ClientTimeout:
+        # A dead connection fails fast even when the whole call may take longer
+        return aiohttp.ClientTimeout(total=total, connect=min(5, total))
+
+    async def _request(self, http_method: str, method: str, timeout: (float | None), **kwargs) -> Any:
+        start = time.perf_counter()
+        try:
+            async with self._session.request(
+                http_method, "",
+                timeout=self._timeout(self.timeout if timeout is None else timeout),
+                **kwargs
+            ) as response:
+                response.raise_for_status()
+                json = await response.json()
+                return json
+        except Exception as e:
+            REQUEST_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, method)
+
+    async def _get(self, method: str, sign: bool = False, params: (dict[str, Any] | None) = None, timeout: (float | None) = None, cache_ttl: (float | None) = None) -> Any:
+        params = self._prepare(method, sign, params)
+
+        key = (method, tuple(sorted(params.items())))
+        if cache_ttl is not None and key in self._cache:
+            expires, response = self._cache[key]
+            if expires > time.monotonic():
+                return response
+            del self._cache[key]
+
+        response = await self._request("GET", method, timeout, params=params)
+
+        if cache_ttl is not None:
+            self._cache[key] = (time.monotonic() + cache_ttl, response)
+            if len(self._cache) > LastFM.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        return response
+
+    async def _post(self, method: str, sign: bool = False, data: (dict[str, Any] | None) = None, timeout: (float | None) = None) -> Any:
+        return await self._request("POST", method, timeout, data=self._prepare(method, sign, data))
 
     def init_session(self):
-        self._session = aiohttp.ClientSession(base_url=LastFM.API_ROOT)
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            limit_per_host=self.connection_limit,
+            keepalive_timeout=60,
+            ttl_dns_cache=300
+        )
+        self._session = aiohttp.ClientSession(
+            base_url=LastFM.API_ROOT,
+            connector=connector,
+            timeout=self._timeout(self.timeout)
+        )
 
     async def auth_get_token(self) -> str:
         response = await self._get("auth.getToken", sign=True)
@@ -135,6 +252,19 @@ class LastFM:
             "sk": session_key
         })
 
+    async def track_scrobble_batch(self, scrobbles: list[dict[str, Any]], session_key: str):
+        # Up to 50 scrobbles in one request, each dict has the same keys as the
+        # arguments to track_scrobble
+        assert len(scrobbles) <= LastFM.SCROBBLE_BATCH_SIZE
+
+        data: dict[str, Any] = { "sk": session_key }
+        for i, scrobble in enumerate(scrobbles):
+            for key, value in scrobble.items():
+                if value is not None:
+                    data[f"{key}[{i}]"] = value
+
+        return await self._post("track.scrobble", sign=True, data=data)
+
     async def track_update_now_playing(self, track: str, artist: str, album: (str | None), album_artist: (str | None), session_key: str):
         return await self._post("track.updateNowPlaying", sign=True, data={
             "track": track,
@@ -145,7 +275,7 @@ class LastFM:
         })
 
     async def user_get_info(self, user: str) -> LastFMUserInfo:
-        response = await self._get("user.getinfo", params={
+        response = await self._get("user.getinfo", cache_ttl=LastFM.USER_INFO_TTL, params={
             "user": user
         })
 
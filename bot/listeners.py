@@ -0,0 +1,100 @@
+from typing import Callable
+import dataclasses
+import discord
+import time
+
+@dataclasses.dataclass
+class Listener:
+    user_id: int
+    joined: float
+    deafened: bool
+    # Seconds of the current track heard before `since`, and when they last
+    # started hearing it
+    heard: float = 0
+    since: float = 0
+
+    def heard_by(self, now: float) -> float:
+        return self.heard + (0 if self.deafened else now - self.since)
+
+# Who is in a voice channel the bot plays in, kept up to date from voice state
+# events instead of going through channel.members every time.
+#
+# Listeners with a linked last.fm account are kept apart from the rest, so
+# deciding who to scrobble for never looks at anyone who can't be scrobbled
+# for. Every listener also counts how much of the current track they actually
+# heard: not before they joined and not while deafened.
+class Roster:
+    def __init__(self, channel: discord.VoiceChannel, has_session: Callable[[int], bool]):
+        self.channel = channel
+        self.has_session = has_session
+
+        self.listeners: dict[int, Listener] = {}
+        self.scrobblers: dict[int, Listener] = {}
+
+        now = time.monotonic()
+        for member in channel.members:
+            self._join(member, member.voice, now)
+
+    def _join(self, member: discord.Member, state: (discord.VoiceState | None), now: float) -> None:
+        if member.bot:
+            return
+
+        listener = Listener(member.id, now, Roster._is_deafened(state), since=now)
+        self.listeners[member.id] = listener
+        if self.has_session(member.id):
+            self.scrobblers[member.id] = listener
+
+    def _leave(self, member: discord.Member) -> None:
+        self.listeners.pop(member.id, None)
+        self.scrobblers.pop(member.id, None)
+
+    @staticmethod
+    def _is_deafened(state: (discord.VoiceState | None)) -> bool:
+        return state is not None and (state.self_deaf or state.deaf)
+
+    def update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState) -> None:
+        # Called for every voice state update in the channel's guild
+        now = time.monotonic()
+        was_here = before.channel is not None and before.channel.id == self.channel.id
+        is_here = after.channel is not None and after.channel.id == self.channel.id
+
+        if is_here and not was_here:
+            self._join(member, after, now)
+        elif was_here and not is_here:
+            self._leave(member)
+        elif is_here:
+            listener = self.listeners.get(member.id)
+            if listener is None:
+                return
+
+            deafened = Roster._is_deafened(after)
+            if deafened and not listener.deafened:
+                listener.heard += now - listener.since
+            elif listener.deafened and not deafened:
+                listener.since = now
+            listener.deafened = deafened
+
+    def session_changed(self, user_id: int) -> None:
+        listener = self.listeners.get(user_id)
+        if listener is None:
+            return
+
+        if self.has_session(user_id):
+            self.scrobblers[user_id] = listener
+        else:
+            self.scrobblers.pop(user_id, None)
+
+    def start_track(self) -> None:
+        now = time.monotonic()
+        for listener in self.listeners.values():
+            listener.heard = 0
+            listener.since = now
+
+    def is_listening(self, user_id: int) -> bool:
+        listener = self.listeners.get(user_id)
+        return listener is not None and not listener.deafened
+
+    def heard_enough(self, seconds: float) -> list[Listener]:
+        # Linked listeners who heard at least `seconds` of the current track
+        now = time.monotonic()
+        return [ listener for listener in self.scrobblers.values() if listener.heard_by(now) >= seconds ]
@@ -0,0 +1,116 @@
+from metadata import MetadataStore
+import asyncio
+import os
+import re
+
+# ReplayGain 2 gains are relative to this loudness
+REPLAYGAIN_REFERENCE = -18.0
+# Quiet tracks aren't boosted further than this, it would only clip
+MAX_GAIN = 10.0
+
+def gain(lufs: float, target: float) -> float:
+    # dB to apply to a track measured at `lufs`, rounded so gains can be part
+    # of a cache key
+    return round(max(-MAX_GAIN, min(MAX_GAIN, target - lufs)), 1)
+
+def read_replaygain(track: str) -> (float | None):
+    # Loudness implied by a REPLAYGAIN_TRACK_GAIN tag, if the file has one
+    import tinytag
+
+    try:
+        tag = tinytag.TinyTag.get(track)
+    except tinytag.TinyTagException:
+        return None
+
+    # "other" in tinytag 2, "extra" before that
+    fields = getattr(tag, "other", None) or getattr(tag, "extra", None) or {}
+    value = fields.get("replaygain_track_gain")
+    if isinstance(value, list):
+        value = value[0] if len(value) > 0 else None
+    if value is None:
+        return None
+
+    match = re.match(r"\s*([+-]?\d+(?:\.\d+)?)", str(value))
+    if match is None:
+        return None
+
+    return REPLAYGAIN_REFERENCE - float(match.group(1))
+
+# Niceness of analysis processes, they should only use CPU time playback
+# doesn't need
+ANALYSIS_NICENESS = 10
+
+# Measures every track's loudness once, in the background, and stores it with
+# the rest of the track's metadata. Tracks with ReplayGain tags are taken at
+# their word, everything else gets an EBU R128 analysis by FFmpeg. At most
+# `workers` analyses run at once and at a lower priority than the bot, so
+# they never hold up encoding for playback.
+class LoudnessAnalyzer:
+    def __init__(self, store: MetadataStore, workers: int = 1):
+        self.store = store
+        self.workers = workers
+        self._slots = asyncio.Semaphore(workers)
+
+    async def _measure(self, track: str) -> (float | None):
+        async with self._slots:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-threads", "1",
+                "-i", track,
+                "-map", "0:a:0", "-af", "ebur128=framelog=quiet",
+                "-f", "null", "-",
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+
+            # Set from here rather than in the child before exec, which isn't
+            # safe with the threads this process has
+            if hasattr(os, "setpriority"):
+                try:
+                    os.setpriority(os.PRIO_PROCESS, process.pid, ANALYSIS_NICENESS)
+                except OSError:
+                    pass
+
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+
+        output = stderr.decode(errors="replace")
+        if process.returncode != 0:
+            print(f"Couldn't measure loudness of {track}: {output.strip()}")
+            return None
+
+        # The summary at the end has the integrated loudness for the whole track
+        measured = re.findall(r"I:\s+(-?\d+(?:\.\d+)?) LUFS", output)
+        return float(measured[-1]) if len(measured) > 0 else None
+
+    async def analyze(self, track: str) -> None:
+        signature = await self.store.signature(track)
+        if signature is None:
+            return
+
+        lufs = await asyncio.to_thread(read_replaygain, track)
+        if lufs is None:
+            lufs = await self._measure(track)
+
+        await self.store.set_loudness(track, signature, lufs)
+
+    async def run(self, tracks: list[str]) -> None:
+        # Picks up where a previous run stopped, measured tracks are skipped
+        unmeasured = await self.store.unmeasured(tracks)
+        if len(unmeasured) == 0:
+            return
+
+        print(f"Measuring loudness of {len(unmeasured)} track(s)")
+        remaining = iter(unmeasured)
+
+        async def worker():
+            for track in remaining:
+                try:
+                    await self.analyze(track)
+                except Exception as e:
+                    print(f"Couldn't measure loudness of {track}: {e}")
+
+        await asyncio.gather(*[ worker() for _ in range(self.workers) ])
+        print(f"Measured loudness of {len(unmeasured)} track(s)")
@@ -0,0 +1,301 @@
+from typing import Callable
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import metrics
+import os
+import sqlite3
+import time
+
+TAG_READ_SECONDS = metrics.Histogram("tag_read_seconds", "Time spent reading tags from a file")
+
+@dataclasses.dataclass
+class Metadata:
+    title: (str | None)
+    artist: (str | None)
+    album: (str | None)
+    album_artist: (str | None)
+    duration: float
+
+def read_tags(track: str) -> (Metadata | None):
+    # None for files tinytag can't make sense of or that don't say how long they
+    # are, errors opening the file are still raised
+    import tinytag # Only needed once tags are actually read, it's slow to import
+
+    try:
+        tag = tinytag.TinyTag.get(track)
+    except tinytag.TinyTagException:
+        return None
+
+    if tag.duration is None:
+        return None
+
+    return Metadata(tag.title, tag.artist, tag.album, tag.albumartist, tag.duration)
+
+def _read_chunk(tracks: list[str]) -> list[tuple[str, (tuple[int, int] | None), (Metadata | None), (str | None)]]:
+    # Runs in a worker process: (track, (mtime_ns, size), metadata, error) for
+    # every track, the signature is None if the file couldn't be read at all
+    results: list[tuple[str, (tuple[int, int] | None), (Metadata | None), (str | None)]] = []
+    for track in tracks:
+        try:
+            stat = os.stat(track)
+            results.append((track, (stat.st_mtime_ns, stat.st_size), read_tags(track), None))
+        except Exception as e:
+            results.append((track, None, None, f"{type(e).__name__}: {e}"))
+    return results
+
+@dataclasses.dataclass
+class ExtractProgress:
+    total: int
+    # Already in the store before this run
+    skipped: int = 0
+    read: int = 0
+    # Read, but without usable metadata
+    no_metadata: int = 0
+    failed: int = 0
+    started: float = dataclasses.field(default_factory=time.perf_counter)
+
+    @property
+    def done(self) -> int:
+        return self.skipped + self.read + self.failed
+
+    @property
+    def files_per_second(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.read / elapsed if elapsed > 0 else 0
+
+# On-disk index of track tags, keyed by path. A row is only trusted while the
+# file's mtime and size still match, otherwise the tags are read again. All
+# database access happens on a single worker thread so tag reads never block
+# the event loop.
+class MetadataStore:
+    FILL_CHUNK_SIZE: int = 64
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="metadata")
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                album_artist TEXT,
+                duration REAL
+            );
+            CREATE TABLE IF NOT EXISTS loudness (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                lufs REAL
+            );
+        """)
+
+    def _lookup(self, track: str, signature: tuple[int, int]) -> (tuple[Metadata | None] | None):
+        row = self._connection.execute(
+            "SELECT mtime_ns, size, title, artist, album, album_artist, duration FROM tracks WHERE path = ?",
+            (track, )
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        mtime_ns, size, *fields = row
+        if (mtime_ns, size) != signature:
+            return None
+
+        # Rows without a duration are files we couldn't get metadata from, remember
+        # that too so they aren't read again on every play
+        if fields[-1] is None:
+            return (None, )
+
+        return (Metadata(*fields), )
+
+    def _store(self, track: str, signature: tuple[int, int], metadata: (Metadata | None)) -> None:
+        mtime_ns, size = signature
+        fields = (None, ) * 5 if metadata is None else dataclasses.astuple(metadata)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (track, mtime_ns, size, *fields)
+        )
+
+    def _get(self, track: str, commit: bool = True) -> (Metadata | None):
+        stat = os.stat(track)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        cached = self._lookup(track, signature)
+        if cached is not None:
+            return cached[0]
+
+        start = time.perf_counter()
+        metadata = read_tags(track)
+        TAG_READ_SECONDS.observe(time.perf_counter() - start)
+
+        self._store(track, signature, metadata)
+        if commit:
+            self._connection.commit()
+
+        return metadata
+
+    def _fill(self, tracks: list[str]) -> int:
+        read = 0
+        for track in tracks:
+            try:
+                stat = os.stat(track)
+                if self._lookup(track, (stat.st_mtime_ns, stat.st_size)) is not None:
+                    continue
+
+                self._get(track, commit=False)
+                read += 1
+            except Exception as e:
+                print(f"Couldn't index metadata for {track}: {e}")
+
+        self._connection.commit()
+        return read
+
+    def _missing(self, tracks: list[str]) -> list[str]:
+        missing: list[str] = []
+        for track in tracks:
+            try:
+                stat = os.stat(track)
+            except OSError:
+                # Left for the workers to report
+                missing.append(track)
+                continue
+
+            if self._lookup(track, (stat.st_mtime_ns, stat.st_size)) is None:
+                missing.append(track)
+        return missing
+
+    def extract(self, tracks: list[str], workers: (int | None) = None, chunk_size: int = 256, progress: (Callable[[ExtractProgress], None] | None) = None) -> ExtractProgress:
+        # Bulk version of fill for indexing a whole library: tags are read in
+        # chunks on a process pool and every finished chunk is committed, so an
+        # interrupted run picks up where it left off. Files that couldn't be
+        # opened aren't stored and are tried again next time.
+        #
+        # Blocks, and mustn't be used while the async methods are in use.
+        missing = self._missing(tracks)
+        status = ExtractProgress(len(tracks), skipped=len(tracks) - len(missing))
+        if progress is not None:
+            progress(status)
+
+        chunks = collections.deque(missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size))
+        workers = workers or os.cpu_count() or 1
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            # Only a few chunks in flight at a time, results are written as they
+            # come in instead of all at the end
+            in_flight: set[concurrent.futures.Future] = set()
+
+            try:
+                while len(chunks) > 0 or len(in_flight) > 0:
+                    while len(chunks) > 0 and len(in_flight) < workers * 2:
+                        in_flight.add(executor.submit(_read_chunk, chunks.popleft()))
+
+                    finished, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                    for future in finished:
+                        for track, signature, metadata, error in future.result():
+                            if signature is None:
+                                print(f"Couldn't read metadata from {track}: {error}")
+                                status.failed += 1
+                                continue
+
+                            self._store(track, signature, metadata)
+                            status.read += 1
+                            if metadata is None:
+                                status.no_metadata += 1
+
+                        self._connection.commit()
+
+                    if progress is not None:
+                        progress(status)
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        return status
+
+    def _signature(self, track: str) -> (tuple[int, int] | None):
+        try:
+            stat = os.stat(track)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _loudness(self, track: str) -> (tuple[float | None] | None):
+        # Like _lookup, (None, ) for tracks that couldn't be measured
+        row = self._connection.execute(
+            "SELECT mtime_ns, size, lufs FROM loudness WHERE path = ?",
+            (track, )
+        ).fetchone()
+
+        if row is None or row[:2] != self._signature(track):
+            return None
+
+        return (row[2], )
+
+    def _store_loudness(self, track: str, signature: tuple[int, int], lufs: (float | None)) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO loudness VALUES (?, ?, ?, ?)",
+            (track, *signature, lufs)
+        )
+        self._connection.commit()
+
+    def _unmeasured(self, tracks: list[str]) -> list[str]:
+        return [ track for track in tracks if self._loudness(track) is None ]
+
+    def _all(self) -> dict[str, Metadata]:
+        return {
+            path: Metadata(*fields)
+            for path, *fields in self._connection.execute(
+                "SELECT path, title, artist, album, album_artist, duration FROM tracks WHERE duration IS NOT NULL"
+            )
+        }
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, track: str) -> (Metadata | None):
+        return await self._run(self._get, track)
+
+    async def loudness(self, track: str) -> (float | None):
+        # Integrated loudness in LUFS, None if it hasn't been measured (yet)
+        measured = await self._run(self._loudness, track)
+        return None if measured is None else measured[0]
+
+    async def signature(self, track: str) -> (tuple[int, int] | None):
+        return await self._run(self._signature, track)
+
+    async def set_loudness(self, track: str, signature: tuple[int, int], lufs: (float | None)) -> None:
+        # `signature` is from before the track was measured, so a file that
+        # changed in the meantime is measured again
+        await self._run(self._store_loudness, track, signature, lufs)
+
+    async def unmeasured(self, tracks: list[str]) -> list[str]:
+        unmeasured: list[str] = []
+        for i in range(0, len(tracks), MetadataStore.FILL_CHUNK_SIZE):
+            unmeasured.extend(await self._run(self._unmeasured, tracks[i:i + MetadataStore.FILL_CHUNK_SIZE]))
+        return unmeasured
+
+    async def all(self) -> dict[str, Metadata]:
+        # Everything in the store, without checking whether files changed since
+        return await self._run(self._all)
+
+    async def fill(self, tracks: list[str]) -> None:
+        # Submitted in small chunks so a lookup for the track that's about to play
+        # doesn't have to wait for the whole library to be indexed
+        read = 0
+        for i in range(0, len(tracks), MetadataStore.FILL_CHUNK_SIZE):
+            read += await self._run(self._fill, tracks[i:i + MetadataStore.FILL_CHUNK_SIZE])
+
+        print(f"Indexed metadata for {read} new or changed track(s)")
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self._connection.close()
@@ -0,0 +1,141 @@
+from typing import Callable
+import asyncio
+import bisect
+import collections
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Minimal Prometheus style metrics. Every metric can have labels, values are
+# kept per tuple of label values. Metrics register themselves in REGISTRY when
+# they're created, which is what gets served on /metrics.
+
+REGISTRY: list["Counter | Gauge | Histogram"] = []
+
+class Counter:
+    TYPE = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: collections.Counter[tuple[str, ...]] = collections.Counter()
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] += amount
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], float]]:
+        return [ (self.name, labels, value) for labels, value in self.values.items() ]
+
+class Gauge:
+    TYPE = "gauge"
+
+    # If `callback` is given it's asked for the current values at scrape time,
+    # either a single number or a dict of label values -> number
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), callback: (Callable[[], (float | dict[tuple[str, ...], float])] | None) = None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+        self.values: dict[tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], float]]:
+        values = self.values
+        if self.callback is not None:
+            result = self.callback()
+            values = result if isinstance(result, dict) else { (): result }
+
+        return [ (self.name, labels, value) for labels, value in values.items() ]
+
+class Histogram:
+    TYPE = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+        # Per label values: count per bucket (the last one is +Inf), sum, count
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        if labels not in self.values:
+            self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+
+        counts, totals = self.values[labels]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def summary(self, *labels: str) -> (tuple[float, int] | None):
+        # (mean, count) for the given label values
+        if labels not in self.values:
+            return None
+
+        _, (total, count) = self.values[labels]
+        return (total / count, int(count))
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], float]]:
+        samples: list[tuple[str, tuple[str, ...], float]] = []
+
+        for labels, (counts, (total, count)) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                samples.append((f"{self.name}_bucket", (*labels, str(bound)), cumulative))
+
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+
+        return samples
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def render() -> str:
+    lines: list[str] = []
+
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+
+        names = metric.labels
+        for name, labels, value in metric.samples():
+            label_names = (*names, "le") if name.endswith("_bucket") else names
+            if len(labels) > 0:
+                pairs = ",".join(f"{key}=\"{_escape(str(label))}\"" for key, label in zip(label_names, labels))
+                lines.append(f"{name}{{{pairs}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+async def serve(host: str, port: int) -> None:
+    # Serves /metrics from the bot's own event loop
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+async def monitor_loop_lag(histogram: Histogram, gauge: Gauge, interval: float = 1) -> None:
+    # How late the event loop wakes us up is how long something else held it
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0, loop.time() - start - interval)
+        histogram.observe(lag)
+        gauge.set(lag)
@@ -1,92 +1,153 @@
-from config import *
+from metadata import Metadata, MetadataStore
+from player import Player
 from playlists.common import Playlist
+from scrobbler import ScrobbleDispatcher
+from settings import *
+from typing import Callable
 import asyncio
-import dataclasses
+import concurrent.futures
 import discord
+import hashlib
 import lastfm
+import loudness
+import metrics
 import os
 import playlists
-import random
-import time
-import tinytag
-
-@dataclasses.dataclass
-class Metadata:
-    title: (str | None)
-    artist: (str | None)
-    album: (str | None)
-    album_artist: (str | None)
-    duration: float
+import search
+import selection
+import stalls
+import transcode
+
+LOOP_LAG_SECONDS = metrics.Histogram("event_loop_lag_seconds", "How late the event loop ran a timer")
+LOOP_LAG = metrics.Gauge("event_loop_lag_last_seconds", "Event loop lag from the most recent check")
+RELOAD_SECONDS = metrics.Histogram("playlist_reload_seconds", "Time taken to load playlists, per source", ("source", ), buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+PLAYLIST_TRACKS = metrics.Gauge("playlist_tracks", "Tracks loaded per source", ("source", ))
+VOICE_SESSIONS = metrics.Gauge("voice_sessions_active", "Guilds currently playing")
+SEARCH_INDEX_ENTRIES = metrics.Gauge("search_index_entries", "Entries in the search indexes", ("index", ))
 
 class MusicBot(discord.Client):
-    def __init__(self, lfm: lastfm.LastFM, lfmsm: lastfm.LastFMSessionManager):
+    def __init__(self, lfm: lastfm.LastFM, lfmsm: lastfm.LastFMSessionManager, scrobbles: ScrobbleDispatcher, metadata: MetadataStore, transcodes: (transcode.TranscodeCache | None) = None, downloads: (transcode.TranscodeCache | None) = None):
         super().__init__(intents=discord.Intents.default())
         self.tree = discord.app_commands.CommandTree(self)
-        self.playing: bool = False
         self.lfm = lfm
         self.lfmsm = lfmsm
-        self.track: (str | None) = None
-
-        self._vc: discord.VoiceClient
-        self._skip: bool = False
+        self.scrobbles = scrobbles
+        self.metadata = metadata
+        self.transcodes = transcodes
+        self.downloads = downloads
+        self.players: dict[int, Player] = {}
         self.playlists: list[Playlist] = []
-        self._scrobble_queue: list[tuple[str, bool, Metadata]] = []
-
-    async def scrobbler(self):
-        while True:
-            while len(self._scrobble_queue) > 0:
-                user_id, scrobble, metadata = self._scrobble_queue.pop(0)
-                session = self.lfmsm.get_session(user_id)
-                if session is None:
-                    print(f"Couldn't find last.fm session key for {user_id}")
-                    continue
+        self.playlist_index = search.SearchIndex()
+        self.track_index = search.SearchIndex()
+        self._playlists_by_name: dict[str, Playlist] = {}
+        self._playlists_by_key: dict[str, Playlist] = {}
+        self._index_task: (asyncio.Task | None) = None
+        self._track_stats: (dict[int, tuple[int, float]] | None) = None
+        self._reload_lock = asyncio.Lock()
+        self._reload_executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="playlists")
+        self._playlists_by_source: dict[str, list[Playlist]] = {}
+        self.stalls: (stalls.StallDetector | None) = None
+        # Until the first reload finished, playlists may be missing or from the
+        # previous run's snapshot
+        self.loading: bool = True
+
+        self.loudness: (loudness.LoudnessAnalyzer | None) = None
+        self._loudness_task: (asyncio.Task | None) = None
+        if LOUDNESS_NORMALIZATION:
+            self.loudness = loudness.LoudnessAnalyzer(metadata, LOUDNESS_WORKERS)
+
+        VOICE_SESSIONS.callback = lambda: sum(1 for player in self.players.values() if player.playing)
+        SEARCH_INDEX_ENTRIES.callback = lambda: {
+            ("playlists", ): len(self.playlist_index),
+            ("tracks", ): len(self.track_index)
+        }
+
+    def player(self, guild: discord.Guild) -> Player:
+        if guild.id not in self.players:
+            self.players[guild.id] = Player(self, guild)
+        return self.players[guild.id]
+
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        player = self.players.get(member.guild.id)
+        if player is not None and player.roster is not None:
+            player.roster.update(member, before, after)
+
+    def session_changed(self, user_id: int) -> None:
+        # Called after a last.fm account is linked or unlinked
+        for player in self.players.values():
+            if player.roster is not None:
+                player.roster.session_changed(user_id)
+
+    def queue_scrobble(self, user_id: str, scrobble: bool, metadata: Metadata, is_listening: (Callable[[], bool] | None) = None) -> None:
+        if scrobble:
+            self.scrobbles.scrobble(user_id, metadata)
+        else:
+            self.scrobbles.now_playing(user_id, metadata, is_listening)
+
+    async def close(self):
+        await super().close()
+
+        # Makes sure pending writes end up on disk
+        self.lfmsm.close()
+        self.metadata.close()
+
+        if self.stalls is not None:
+            self.stalls.write_report()
+
+    async def setup_hook(self):
+        # Runs once before connecting, unlike on_ready which runs on every reconnect
+        self.loop.create_task(metrics.monitor_loop_lag(LOOP_LAG_SECONDS, LOOP_LAG))
+
+        if STALL_THRESHOLD is not None:
+            self.stalls = stalls.StallDetector(STALL_THRESHOLD, STALL_REPORT_PATH)
+            self.stalls.start(self.loop)
+
+        if METRICS_PORT is not None:
+            print(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}")
+            await metrics.serve(METRICS_HOST, METRICS_PORT)
 
-                name, session_key = session
+        print(f"Initializing last.fm scrobbler")
+        self.lfm.init_session()
+        self.loop.create_task(self.scrobbles.run())
 
-                if metadata.artist is None or metadata.title is None:
-                    print(f"Not scrobbling for {user_id} ({name}) because there's not artist or title field")
-                    continue
+        if self.transcodes is not None:
+            print(f"Starting {self.transcodes.workers} transcode worker(s)")
+            self.transcodes.start(self.loop)
 
-                print(f"Scrobbling {metadata} for {name} ({scrobble=})")
-
-                if scrobble:
-                    await self.lfm.track_scrobble(
-                        track=metadata.title,
-                        artist=metadata.artist,
-                        album=metadata.album,
-                        album_artist=(
-                            metadata.artist
-                            if metadata.album_artist is None else
-                            metadata.album_artist
-                        ),
-                        timestamp=int(time.time()),
-                        session_key=session_key
-                    )
-                else:
-                    await self.lfm.track_update_now_playing(
-                        track=metadata.title,
-                        artist=metadata.artist,
-                        album=metadata.album,
-                        album_artist=(
-                            metadata.artist
-                            if metadata.album_artist is None else
-                            metadata.album_artist
-                        ),
-                        session_key=session_key
-                    )
-
-            await asyncio.sleep(5)
+        # Playlists load in the background while connecting, commands that need
+        # them say so until they're there
+        self.loop.create_task(self._load_playlists())
 
-    async def on_ready(self):
-        print(f"Syncing command tree")
-        #await self.tree.sync()
+    async def _load_playlists(self) -> None:
+        if PLAYLIST_SNAPSHOT_PATH is not None:
+            try:
+                cached = await self.loop.run_in_executor(self._reload_executor, playlists.snapshot.load, PLAYLIST_SNAPSHOT_PATH)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Couldn't read playlist snapshot {PLAYLIST_SNAPSHOT_PATH}: {e}")
+                cached = {}
+
+            if len(cached) > 0 and len(self._playlists_by_source) == 0:
+                self._playlists_by_source = cached
+                self._publish_playlists()
+                print(f"Loaded {len(self.playlists)} playlist(s) from the previous run")
 
         print(f"Reloading playlists")
-        self.reload_playlists()
+        for result in await self.reload_playlists():
+            print(f" - {result.source}: {len(result.playlists)} playlist(s) in {result.duration:.2f}s")
 
-        print(f"Initializing last.fm scrobbler")
-        self.lfm.init_session()
-        self.loop.create_task(self.scrobbler())
+        self.loading = False
+
+        print(f"Have {len(self.playlists)} playlist(s)")
+        for playlist in self.playlists:
+            print(f" - {playlist.name} ({len(playlist.tracks)} track(s))")
+
+        if COLLECTION_WATCH and COLLECTION_PATH is not None:
+            print(f"Watching {COLLECTION_PATH} for changes")
+            self.loop.create_task(self.watch_collection())
+
+    async def on_ready(self):
+        print(f"Syncing command tree")
+        #await self.tree.sync()
 
         print(f"Commands:")
         for item in self.tree.walk_commands():
@@ -100,82 +161,133 @@ class MusicBot(discord.Client):
                     continue
                 print(f" - {item.name}")
 
-        print(f"Have {len(self.playlists)} playlist(s)")
-        for playlist in self.playlists:
-            print(f" - {playlist.name} ({len(playlist.tracks)} track(s))")
+        print(f"Bot ready" + (", still loading playlists" if self.loading else ""))
 
-        print(f"Bot ready")
+    @property
+    def indexing(self) -> bool:
+        return self._index_task is not None and not self._index_task.done()
 
     def find_playlist_by_name(self, playlist_name: str) -> (Playlist | None):
+        return self._playlists_by_name.get(playlist_name)
+
+    @staticmethod
+    def playlist_key(playlist_name: str) -> str:
+        # Names that fit in an autocomplete choice value (100 characters) are
+        # their own key, longer ones are cut short and made unique with a hash
+        if len(playlist_name) <= 100:
+            return playlist_name
+        return playlist_name[:83] + "#" + hashlib.sha1(playlist_name.encode("utf-8")).hexdigest()[:16]
+
+    def find_playlist_by_key(self, key: str) -> (Playlist | None):
+        return self._playlists_by_key.get(key)
+
+    def _publish_playlists(self) -> None:
+        # Swapped in with a single assignment so nothing ever sees a half reloaded list
+        self.playlists = [ playlist for source in self._playlists_by_source.values() for playlist in source ]
+
+        playlists_by_name: dict[str, Playlist] = {}
         for playlist in self.playlists:
-            if playlist.name == playlist_name:
-                return playlist
-
-        return None
-
-    def reload_playlists(self) -> None:
-        self.playlists = playlists.parse_all_playlists(playlists.SearchPaths(
-            xspf_path=PLAYLISTS_PATH,
-            collection_path=COLLECTION_PATH
-        ))
-
-    def get_metadata(self, track: str) -> (Metadata | None):
-        tag = tinytag.TinyTag.get(track)
-        assert tag.duration is not None # Not sure why there wouldn't be a duration
-        metadata = Metadata(tag.title, tag.artist, tag.album, tag.albumartist, tag.duration)
-        return metadata
-
-    async def dj(self, playlist: Playlist, channel: discord.VoiceChannel, updates: discord.TextChannel):
-        while self.playing:
-            self.track = random.choice(playlist.tracks)
-            self._vc.play(discord.FFmpegOpusAudio(self.track, bitrate=256))
-
-            play_start = time.time()
-            scrobbled = False
-
-            metadata = self.get_metadata(self.track)
-
-            if metadata is not None:
-                await updates.send(f"Now playing {metadata.title} by {metadata.artist}")
-                for member in channel.members:
-                    if member.id != self.application_id:
-                        self._scrobble_queue.append((str(member.id), False, metadata))
-            else:
-                await updates.send(f"Now playing `{self.track}`\n-# This track will not scrobble because it does not have any metadata")
+            playlists_by_name.setdefault(playlist.name, playlist)
+        self._playlists_by_name = playlists_by_name
+        self._playlists_by_key = { MusicBot.playlist_key(name): playlist for name, playlist in playlists_by_name.items() }
+        self.playlist_index.update({ name: name for name in playlists_by_name })
+
+    async def reload_playlists(self) -> list[playlists.SourceResult]:
+        async with self._reload_lock:
+            results: list[playlists.SourceResult] = []
+
+            # Every source shows up as soon as it's loaded
+            async for result in playlists.iter_sources(playlists.SearchPaths(
+                xspf_path=PLAYLISTS_PATH,
+                collection_path=COLLECTION_PATH,
+                collection_snapshot=COLLECTION_SNAPSHOT_PATH
+            ), self._reload_executor):
+                results.append(result)
+                RELOAD_SECONDS.observe(result.duration, result.source)
+
+                if result.error is not None:
+                    # Keep whatever we had from this source last time
+                    print(f"Couldn't load playlists from {result.source}: {result.error}")
+                    continue
+
+                self._playlists_by_source[result.source] = result.playlists
+                PLAYLIST_TRACKS.set(sum(len(playlist.tracks) for playlist in result.playlists), result.source)
+                self._publish_playlists()
 
-            while self._vc.is_playing():
-                if self._skip:
-                    self._vc.stop()
-                    self._skip = False
-                    break
+            # Sources that aren't configured anymore, possibly from the snapshot
+            loaded = { result.source for result in results }
+            for source in [ source for source in self._playlists_by_source if source not in loaded ]:
+                del self._playlists_by_source[source]
+            self._publish_playlists()
 
-                if metadata is not None and not scrobbled and (time.time() - play_start) > (metadata.duration * 0.5):
-                    for member in channel.members:
-                        if member.id != self.application_id:
-                            self._scrobble_queue.append((str(member.id), True, metadata))
+            self._track_stats = None
+            self.reindex_tracks()
 
-                    scrobbled = True
+            if PLAYLIST_SNAPSHOT_PATH is not None:
+                try:
+                    await self.loop.run_in_executor(self._reload_executor, playlists.snapshot.save, PLAYLIST_SNAPSHOT_PATH, dict(self._playlists_by_source))
+                except OSError as e:
+                    print(f"Couldn't save playlist snapshot {PLAYLIST_SNAPSHOT_PATH}: {e}")
 
-                await asyncio.sleep(1)
+            return results
 
-    async def play(self, playlist: Playlist, channel: discord.VoiceChannel, updates: discord.TextChannel):
-        if self.playing:
-            return
+    def reindex_tracks(self) -> None:
+        if self._index_task is not None:
+            self._index_task.cancel()
+
+        self._index_task = self.loop.create_task(self._index_tracks())
+
+    async def _index_tracks(self) -> None:
+        # Fills in metadata for any new tracks and then brings the track search
+        # index up to date with it
+        ids: set[int] = set()
+        for playlist in self.playlists:
+            ids.update(playlist.tracks)
+        tracks = [ playlists.TRACKS.path(id) for id in ids ]
+        await self.metadata.fill(tracks)
+
+        metadata = await self.metadata.all()
+        await self.track_index.update_async({
+            track: search.describe_track(track, metadata.get(track))
+            for track in tracks
+        })
+        print(f"Indexed {len(self.track_index)} track(s) for search")
+
+        if self.loudness is not None:
+            if self._loudness_task is not None:
+                self._loudness_task.cancel()
+            self._loudness_task = self.loop.create_task(self.loudness.run(tracks))
+
+    async def watch_collection(self) -> None:
+        def on_change(diff: playlists.collection.Diff):
+            print(f"Collection changed: {len(diff.added)} track(s) added, {len(diff.removed)} track(s) removed")
+            self.reindex_tracks()
+
+        await playlists.collection.scanner(COLLECTION_PATH, COLLECTION_SNAPSHOT_PATH).watch(on_change)
+
+    async def track_stats(self) -> dict[int, tuple[int, float]]:
+        # Play counts and ratings from Strawberry, loaded the first time a
+        # weighted mode needs them after every reload
+        if self._track_stats is None:
+            strawberry_db = playlists.STRAWBERRY_DB_PATH_DEFAULT
+            if os.path.exists(strawberry_db):
+                self._track_stats = await self.loop.run_in_executor(self._reload_executor, playlists.strawberry_db.parse_stats, strawberry_db)
+            else:
+                self._track_stats = {}
 
-        self.playing = True
-        self._vc = await channel.connect()
-        self.loop.create_task(self.dj(playlist, channel, updates))
+        return self._track_stats
 
-    async def stop(self):
-        if not self.playing:
-            return
+    async def create_selector(self, playlist: Playlist, mode: str) -> selection.Selector:
+        stats = await self.track_stats() if mode in ("playcount", "rating") else {}
+        return selection.create(mode, playlist, stats)
 
-        self._vc.stop()
-        await self._vc.disconnect()
-        self.playing = False
+    async def get_metadata(self, track: str) -> (Metadata | None):
+        return await self.metadata.get(track)
 
-    def skip(self):
-        if not self.playing:
-            return
+    async def get_gain(self, track: str) -> (float | None):
+        # None until the track's loudness has been measured
+        if self.loudness is None:
+            return None
 
-        self._skip = True
+        lufs = await self.metadata.loudness(track)
+        return None if lufs is None else loudness.gain(lufs, LOUDNESS_TARGET)
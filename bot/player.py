@@ -0,0 +1,256 @@
+from listeners import Roster
+from metadata import Metadata
+from playlists.common import Playlist, TRACKS
+from selection import Selector
+from typing import Callable
+import asyncio
+import collections
+import dataclasses
+import discord
+import metrics
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    import music_bot
+
+FFMPEG_SPAWN_SECONDS = metrics.Histogram("ffmpeg_spawn_seconds", "Time taken to start FFmpeg for a track", ("codec", ))
+INTER_TRACK_GAP_SECONDS = metrics.Histogram("inter_track_gap_seconds", "Time between one track ending and the next one starting")
+
+@dataclasses.dataclass
+class PreparedTrack:
+    track: str
+    metadata: (Metadata | None)
+    source: (discord.FFmpegOpusAudio | None) = None
+    queued: bool = False
+    # Loudness normalization in dB, None to play as is
+    gain: (float | None) = None
+    # Transcoded copy to pass through instead of encoding the track, found when
+    # the track was prepared so starting it needs no filesystem access
+    cached: (str | None) = None
+
+# Playback state for a single guild. Everything that used to be global on the
+# bot (voice client, current track, skip signal) lives here so one process can
+# play in as many guilds as it's in.
+class Player:
+    BITRATE: int = 256
+    # How long before the current track ends FFmpeg is started for the next one
+    PREFETCH_LEAD: float = 10
+    # last.fm counts a track as listened to after half of it or this many
+    # seconds, whichever comes first
+    SCROBBLE_AFTER_MAX: float = 4 * 60
+    # Tracks in a row that can fail to load before playback gives up
+    MAX_SKIPPED: int = 10
+
+    def __init__(self, bot: "music_bot.MusicBot", guild: discord.Guild):
+        self.bot = bot
+        self.guild = guild
+        self.playing: bool = False
+        self.track: (str | None) = None
+        self.playlist: (Playlist | None) = None
+        self.selector: (Selector | None) = None
+        self.roster: (Roster | None) = None
+
+        # Tracks explicitly queued by users, played before any more are picked
+        # from the playlist
+        self.queue: collections.deque[str] = collections.deque()
+
+        # A track the selector already picked that got pushed back by something
+        # being queued, played before the selector is asked for another one
+        self._held: (PreparedTrack | None) = None
+
+        # Seconds between one track ending and the next one starting
+        self.gaps: collections.deque[float] = collections.deque(maxlen=100)
+
+        self._vc: discord.VoiceClient
+        self._track_done = asyncio.Event()
+
+    def create_source(self, prepared: PreparedTrack) -> discord.FFmpegOpusAudio:
+        # Also called from the prefetch timer, so nothing in here may block
+        start = time.perf_counter()
+
+        if prepared.cached is not None:
+            # Cached copies already have the gain applied
+            source = discord.FFmpegOpusAudio(prepared.cached, codec="copy")
+            FFMPEG_SPAWN_SECONDS.observe(time.perf_counter() - start, "copy")
+            return source
+
+        options = None if prepared.gain is None else f"-af volume={prepared.gain}dB"
+        source = discord.FFmpegOpusAudio(prepared.track, bitrate=Player.BITRATE, options=options)
+        FFMPEG_SPAWN_SECONDS.observe(time.perf_counter() - start, "opus")
+        return source
+
+    async def prepare(self, track: str, queued: bool = False) -> PreparedTrack:
+        gain = await self.bot.get_gain(track)
+
+        cached: (str | None) = None
+        transcodes = self.bot.transcodes
+        if transcodes is not None:
+            # Looking it up also marks it as recently used, so it won't be
+            # evicted before it gets played
+            cached = await transcodes.lookup(track, gain)
+            if cached is None:
+                transcodes.request(track, gain)
+
+        return PreparedTrack(track, await self.bot.get_metadata(track), queued=queued, gain=gain, cached=cached)
+
+    async def _next(self) -> PreparedTrack:
+        # A playlist can point at files that are gone, those are skipped, but
+        # not forever in case none of them are there anymore
+        for _ in range(Player.MAX_SKIPPED):
+            queued = len(self.queue) > 0
+            if queued:
+                track = self.queue.popleft()
+            elif self._held is not None:
+                held, self._held = self._held, None
+                return held
+            else:
+                assert self.selector is not None
+                track = TRACKS.path(self.selector.pick())
+
+            try:
+                return await self.prepare(track, queued=queued)
+            except Exception as e:
+                print(f"Skipping {track} in {self.guild.name}: {e}")
+
+        raise RuntimeError(f"Couldn't play any of the last {Player.MAX_SKIPPED} tracks")
+
+    def _after_track(self, error: (Exception | None)) -> None:
+        # Called from the voice client's player thread
+        if error is not None:
+            print(f"Playback error in {self.guild.name}: {error}")
+        self.bot.loop.call_soon_threadsafe(self._track_done.set)
+
+    async def dj(self, roster: Roster, updates: discord.TextChannel):
+        upcoming: (PreparedTrack | None) = None
+
+        try:
+            upcoming = await self._next()
+            track_end: (float | None) = None
+
+            while self.playing:
+                # Something got queued after the next track was already picked
+                if len(self.queue) > 0 and not upcoming.queued:
+                    self._held = upcoming
+                    upcoming = await self._next()
+
+                current = upcoming
+                if current.source is None:
+                    current.source = self.create_source(current)
+
+                self.track = current.track
+                self._track_done.clear()
+                self._vc.play(current.source, after=self._after_track)
+                roster.start_track()
+
+                if track_end is not None:
+                    self.gaps.append(time.perf_counter() - track_end)
+                    INTER_TRACK_GAP_SECONDS.observe(self.gaps[-1])
+                    print(f"Inter-track gap in {self.guild.name} was {self.gaps[-1] * 1000:.0f}ms")
+
+                # Resolve the next track while this one plays, FFmpeg is started for it
+                # shortly before this one ends so the switch over is immediate
+                upcoming = await self._next()
+
+                metadata = current.metadata
+                timers: list[asyncio.TimerHandle] = []
+                scrobble_late: (Callable[[], None] | None) = None
+
+                if metadata is not None:
+                    required = min(metadata.duration * 0.5, Player.SCROBBLE_AFTER_MAX)
+                    scrobbled: set[int] = set()
+
+                    def scrobble(metadata: Metadata = metadata, required: float = required, scrobbled: set[int] = scrobbled):
+                        # Only listeners with a linked account who heard enough of it
+                        for listener in roster.heard_enough(required):
+                            if listener.user_id not in scrobbled:
+                                scrobbled.add(listener.user_id)
+                                self.bot.queue_scrobble(str(listener.user_id), True, metadata)
+
+                    def prefetch(upcoming: PreparedTrack = upcoming):
+                        if upcoming.source is None:
+                            upcoming.source = self.create_source(upcoming)
+
+                    timers.append(self.bot.loop.call_later(required, scrobble))
+                    scrobble_late = scrobble
+                    timers.append(self.bot.loop.call_later(max(0, metadata.duration - Player.PREFETCH_LEAD), prefetch))
+
+                    await updates.send(f"Now playing {metadata.title} by {metadata.artist}")
+                    for listener in list(roster.scrobblers.values()):
+                        self.bot.queue_scrobble(str(listener.user_id), False, metadata, lambda user_id=listener.user_id: roster.is_listening(user_id))
+                else:
+                    await updates.send(f"Now playing `{self.track}`\n-# This track will not scrobble because it does not have any metadata")
+
+                # Woken up by the voice client once the track ends, is skipped or stopped
+                await self._track_done.wait()
+                track_end = time.perf_counter()
+
+                for timer in timers:
+                    timer.cancel()
+
+                # Anyone who joined late but still heard enough by the end
+                if scrobble_late is not None:
+                    scrobble_late()
+        except Exception as e:
+            print(f"Playback in {self.guild.name} stopped: {e}")
+            try:
+                await updates.send(f"Playback stopped: `{e}`")
+            except Exception:
+                pass
+        finally:
+            for leftover in (upcoming, self._held):
+                if leftover is not None and leftover.source is not None:
+                    leftover.source.cleanup()
+            self._held = None
+
+            # Nothing else would ever reset this and every /playlists play would
+            # be told playback is already running. Unless stop() already did, or
+            # a new session started in the meantime.
+            if self.roster is roster:
+                self.playing = False
+                self.roster = None
+                try:
+                    await self._vc.disconnect()
+                except Exception:
+                    pass
+
+    async def play(self, selector: Selector, channel: discord.VoiceChannel, updates: discord.TextChannel) -> bool:
+        if self.playing:
+            return False
+
+        # Set before connecting so a second play can't connect while this one
+        # is, and reset if connecting fails so it doesn't look like playback
+        # is running
+        self.playing = True
+        try:
+            self._vc = await channel.connect()
+        except BaseException:
+            self.playing = False
+            raise
+
+        self.playlist = selector.playlist
+        self.selector = selector
+        self.roster = Roster(channel, lambda user_id: self.bot.lfmsm.get_session(str(user_id)) is not None)
+        self.bot.loop.create_task(self.dj(self.roster, updates))
+        return True
+
+    async def stop(self):
+        if not self.playing:
+            return
+
+        self.playing = False
+        self.roster = None
+        self._vc.stop()
+        self._track_done.set()
+        await self._vc.disconnect()
+
+    def skip(self):
+        if not self.playing:
+            return
+
+        # Stopping the current source makes the voice client call _after_track,
+        # which wakes up dj
+        self._vc.stop()
+
+    def enqueue(self, track: str) -> None:
+        self.queue.append(track)
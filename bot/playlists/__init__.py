@@ -1,7 +1,12 @@
-from . import xspf, strawberry_db, collection
-from .common import Playlist
+from . import xspf, strawberry_db, collection, snapshot
+from .common import Playlist, TRACKS
+from typing import Callable
+import asyncio
+import concurrent.futures
 import dataclasses
+import functools
 import os
+import time
 
 STRAWBERRY_DB_PATH_DEFAULT = os.path.expanduser("~/.local/share/strawberry/strawberry/strawberry.db")
 
@@ -10,17 +15,67 @@ class SearchPaths:
     strawberry_db: str = STRAWBERRY_DB_PATH_DEFAULT
     xspf_path: (str | None) = None
     collection_path: (str | None) = None
+    collection_snapshot: (str | None) = None
 
-def parse_all_playlists(paths: SearchPaths) -> list[Playlist]:
-    playlists: list[Playlist] = []
+@dataclasses.dataclass
+class SourceResult:
+    source: str
+    playlists: list[Playlist]
+    duration: float
+    error: (Exception | None) = None
+
+def _parse_collection(path: str, snapshot_path: (str | None)) -> list[Playlist]:
+    return [ collection.parse(path, snapshot_path) ]
+
+def _sources(paths: SearchPaths) -> dict[str, Callable[[], (list[Playlist] | None)]]:
+    sources: dict[str, Callable[[], (list[Playlist] | None)]] = {}
 
     if os.path.exists(paths.strawberry_db):
-        playlists.extend(strawberry_db.parse(paths.strawberry_db))
+        sources["strawberry_db"] = functools.partial(strawberry_db.parse, paths.strawberry_db)
 
     if paths.xspf_path is not None:
-        playlists.extend(xspf.find_and_parse(paths.xspf_path))
+        sources["xspf"] = functools.partial(xspf.find_and_parse, paths.xspf_path)
 
     if paths.collection_path is not None:
-        playlists.append(collection.parse(paths.collection_path))
+        sources["collection"] = functools.partial(_parse_collection, paths.collection_path, paths.collection_snapshot)
+
+    return sources
+
+def _load(source: str, parse: Callable[[], (list[Playlist] | None)]) -> SourceResult:
+    start = time.perf_counter()
+    try:
+        playlists = parse() or []
+    except Exception as e:
+        return SourceResult(source, [], time.perf_counter() - start, e)
+
+    return SourceResult(source, playlists, time.perf_counter() - start)
+
+def parse_all_playlists(paths: SearchPaths) -> list[Playlist]:
+    playlists: list[Playlist] = []
+
+    for source, parse in _sources(paths).items():
+        result = _load(source, parse)
+        if result.error is not None:
+            raise result.error
+        playlists.extend(result.playlists)
 
     return playlists
+
+async def load_all_sources(paths: SearchPaths, executor: (concurrent.futures.Executor | None) = None) -> list[SourceResult]:
+    # Every source is loaded in parallel on the executor, nothing here touches the
+    # event loop besides waiting for the results
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[
+        loop.run_in_executor(executor, _load, source, parse)
+        for source, parse in _sources(paths).items()
+    ])
+
+async def iter_sources(paths: SearchPaths, executor: (concurrent.futures.Executor | None) = None):
+    # Same as load_all_sources, but every source's result is yielded as soon as
+    # that source is done instead of waiting for the slowest one
+    loop = asyncio.get_running_loop()
+    for future in asyncio.as_completed([
+        loop.run_in_executor(executor, _load, source, parse)
+        for source, parse in _sources(paths).items()
+    ]):
+        yield await future
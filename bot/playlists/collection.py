@@ -1,15 +1,292 @@
+from .common import Playlist, TRACKS, track_ids
+from array import array
+from typing import Callable
+import asyncio
+import dataclasses
+import json
 import os
-from .common import Playlist
+import threading
 
 SUPPORTED_EXTENSIONS = [".mp3", ".m4a", ".flac", ".wav"]
+SNAPSHOT_VERSION = 1
+WATCH_DEBOUNCE = 1.0
 
-def parse(path: str) -> Playlist:
-    playlist = Playlist("All Music", path, [])
+@dataclasses.dataclass
+class Diff:
+    added: list[str]
+    removed: list[str]
 
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            track_path = os.path.join(root, file)
-            if os.path.splitext(file)[1] in SUPPORTED_EXTENSIONS:
-                playlist.tracks.append(track_path)
+    def __bool__(self) -> bool:
+        return len(self.added) > 0 or len(self.removed) > 0
 
-    return playlist
+@dataclasses.dataclass
+class _Directory:
+    mtime_ns: int
+    files: list[str]
+    dirs: list[str]
+
+# Keeps the "All Music" playlist in sync with the collection folder without
+# walking the whole tree every time.
+#
+# A snapshot of every directory's mtime and contents is kept (and optionally
+# saved to disk). A directory's mtime only changes when entries are added to or
+# removed from it, so unchanged directories are only stat'ed, never listed.
+class Scanner:
+    def __init__(self, path: str, snapshot_path: (str | None) = None):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.playlist = Playlist("All Music", path)
+
+        self._dirs: dict[str, _Directory] = {}
+        self._lock = threading.Lock()
+
+        self._load_snapshot()
+
+    def _load_snapshot(self) -> None:
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return
+
+        try:
+            with open(self.snapshot_path, "rb") as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Couldn't read collection snapshot {self.snapshot_path}: {e}")
+            return
+
+        if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("path") != self.path:
+            return
+
+        self._dirs = {
+            directory: _Directory(mtime_ns, files, dirs)
+            for directory, (mtime_ns, files, dirs) in snapshot["dirs"].items()
+        }
+        self.playlist.tracks = track_ids(self._tracks_under(self.path))
+
+    def _save_snapshot(self) -> None:
+        if self.snapshot_path is None:
+            return
+
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "path": self.path,
+            "dirs": {
+                directory: (entry.mtime_ns, entry.files, entry.dirs)
+                for directory, entry in self._dirs.items()
+            }
+        }
+
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(snapshot, file)
+        os.replace(temp_path, self.snapshot_path)
+
+    def _tracks_under(self, directory: str):
+        stack = [directory]
+        while len(stack) > 0:
+            directory = stack.pop()
+            entry = self._dirs.get(directory)
+            if entry is None:
+                continue
+
+            for file in entry.files:
+                yield os.path.join(directory, file)
+
+            stack.extend(os.path.join(directory, d) for d in reversed(entry.dirs))
+
+    def _list(self, directory: str, mtime_ns: int) -> _Directory:
+        entry = _Directory(mtime_ns, [], [])
+
+        try:
+            # Same rules as os.walk: symlinked files are included, symlinked
+            # directories aren't followed
+            for item in os.scandir(directory):
+                if item.is_dir():
+                    if not item.is_symlink():
+                        entry.dirs.append(item.name)
+                elif os.path.splitext(item.name)[1] in SUPPORTED_EXTENSIONS:
+                    entry.files.append(item.name)
+        except OSError:
+            pass
+
+        entry.files.sort()
+        entry.dirs.sort()
+        return entry
+
+    def _forget(self, directory: str, removed: list[str]) -> None:
+        removed.extend(self._tracks_under(directory))
+
+        stack = [directory]
+        while len(stack) > 0:
+            directory = stack.pop()
+            entry = self._dirs.pop(directory, None)
+            if entry is not None:
+                stack.extend(os.path.join(directory, d) for d in entry.dirs)
+
+    # Bring the snapshot up to date starting from `roots`. Directories in `force`
+    # are listed even if their mtime didn't change. If `descend_unchanged` is
+    # False only directories we haven't seen before are recursed into, which is
+    # what the watcher wants since it's told exactly which directories changed.
+    def _update(self, roots: list[str], force: set[str], descend_unchanged: bool) -> tuple[Diff, list[str]]:
+        diff = Diff([], [])
+        listed: list[str] = []
+
+        stack = list(roots)
+        while len(stack) > 0:
+            directory = stack.pop()
+            old = self._dirs.get(directory)
+
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                self._forget(directory, diff.removed)
+                continue
+
+            if old is not None and old.mtime_ns == mtime_ns and directory not in force:
+                if descend_unchanged:
+                    stack.extend(os.path.join(directory, d) for d in old.dirs)
+                continue
+
+            new = self._list(directory, mtime_ns)
+            self._dirs[directory] = new
+            listed.append(directory)
+
+            old_files = set() if old is None else set(old.files)
+            new_files = set(new.files)
+            diff.added.extend(os.path.join(directory, f) for f in new.files if f not in old_files)
+
+            if old is not None:
+                diff.removed.extend(os.path.join(directory, f) for f in old.files if f not in new_files)
+
+                new_dirs = set(new.dirs)
+                for d in old.dirs:
+                    if d not in new_dirs:
+                        self._forget(os.path.join(directory, d), diff.removed)
+
+            for d in new.dirs:
+                subdirectory = os.path.join(directory, d)
+                if descend_unchanged or subdirectory not in self._dirs:
+                    stack.append(subdirectory)
+
+        return diff, listed
+
+    def _apply(self, diff: Diff) -> None:
+        tracks = self.playlist.tracks
+        if len(diff.removed) > 0:
+            removed = { TRACKS.id(track) for track in diff.removed }
+            tracks = array("I", (id for id in tracks if id not in removed))
+        else:
+            tracks = array("I", tracks)
+
+        tracks.extend(track_ids(diff.added))
+
+        # Swapped in as a whole so readers never see a half applied diff
+        self.playlist.tracks = tracks
+
+    def _refresh(self, roots: list[str], force: set[str], descend_unchanged: bool) -> tuple[Diff, list[str]]:
+        with self._lock:
+            diff, listed = self._update(roots, force, descend_unchanged)
+            if diff:
+                self._apply(diff)
+            if len(listed) > 0:
+                self._save_snapshot()
+            return diff, listed
+
+    def scan(self) -> Diff:
+        diff, _ = self._refresh([self.path], set(), True)
+        return diff
+
+    async def watch(self, on_change: (Callable[[Diff], None] | None) = None) -> None:
+        # Keeps the collection live using inotify so no rescans are needed
+        try:
+            import inotify_simple
+        except ImportError:
+            raise RuntimeError("Watching the collection requires the inotify_simple package")
+
+        flags = inotify_simple.flags
+        mask = flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF | flags.MOVE_SELF
+
+        inotify = inotify_simple.INotify()
+        watches: dict[int, str] = {}
+        watched: set[str] = set()
+
+        def add_watches(directories: list[str]):
+            for directory in directories:
+                if directory in watched:
+                    continue
+
+                try:
+                    watches[inotify.add_watch(directory, mask)] = directory
+                    watched.add(directory)
+                except OSError as e:
+                    print(f"Couldn't watch {directory}: {e}")
+
+        # Events are read as soon as they arrive, otherwise the reader would
+        # stay ready and the loop would spin until the debounce is over. Only
+        # what's needed to handle them is kept until then.
+        changed: set[int] = set()
+        ignored: set[int] = set()
+        overflowed = False
+        readable = asyncio.Event()
+
+        def read_events():
+            nonlocal overflowed
+            for event in inotify.read(timeout=0):
+                if event.mask & flags.Q_OVERFLOW:
+                    overflowed = True
+                if event.mask & flags.IGNORED:
+                    ignored.add(event.wd)
+                else:
+                    changed.add(event.wd)
+            readable.set()
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(inotify.fileno(), read_events)
+
+        try:
+            # Catch up with anything that changed while we weren't watching
+            diff = await asyncio.to_thread(self.scan)
+            if diff and on_change is not None:
+                on_change(diff)
+
+            with self._lock:
+                directories = list(self._dirs.keys())
+            await asyncio.to_thread(add_watches, directories)
+
+            while True:
+                await readable.wait()
+                await asyncio.sleep(WATCH_DEBOUNCE)
+                readable.clear()
+
+                rescan, overflowed = overflowed, False
+                dirty = { watches[wd] for wd in changed if wd in watches }
+                changed.clear()
+                for wd in ignored:
+                    watched.discard(watches.pop(wd, ""))
+                ignored.clear()
+
+                if rescan:
+                    diff, listed = await asyncio.to_thread(self._refresh, [self.path], set(), True)
+                elif len(dirty) > 0:
+                    diff, listed = await asyncio.to_thread(self._refresh, list(dirty), dirty, False)
+                else:
+                    continue
+
+                await asyncio.to_thread(add_watches, listed)
+
+                if diff and on_change is not None:
+                    on_change(diff)
+        finally:
+            loop.remove_reader(inotify.fileno())
+            inotify.close()
+
+_scanners: dict[str, Scanner] = {}
+
+def scanner(path: str, snapshot_path: (str | None) = None) -> Scanner:
+    if path not in _scanners:
+        _scanners[path] = Scanner(path, snapshot_path)
+    return _scanners[path]
+
+def parse(path: str, snapshot_path: (str | None) = None) -> Playlist:
+    collection = scanner(path, snapshot_path)
+    collection.scan()
+    return collection.playlist
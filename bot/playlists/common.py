@@ -1,7 +1,54 @@
+from array import array
 import dataclasses
+import threading
+
+# Every track path the bot knows about, stored once and given an integer ID.
+# Playlists only hold arrays of these IDs, so the same path showing up in the
+# collection and a dozen playlists costs 4 bytes per extra appearance instead
+# of another copy of the string.
+class TrackTable:
+    def __init__(self):
+        self._paths: list[str] = []
+        self._ids: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def intern(self, path: str) -> int:
+        id = self._ids.get(path)
+        if id is not None:
+            return id
+
+        # Sources are loaded on several threads at once
+        with self._lock:
+            id = self._ids.get(path)
+            if id is None:
+                id = len(self._paths)
+                self._paths.append(path)
+                self._ids[path] = id
+            return id
+
+    def id(self, path: str) -> (int | None):
+        return self._ids.get(path)
+
+    def path(self, id: int) -> str:
+        return self._paths[id]
+
+TRACKS = TrackTable()
+
+def track_ids(paths) -> array:
+    return array("I", map(TRACKS.intern, paths))
 
 @dataclasses.dataclass
 class Playlist:
     name: str
     source: str
-    tracks: list[str]
+    # IDs into TRACKS
+    tracks: array = dataclasses.field(default_factory=lambda: array("I"))
+
+    def track(self, index: int) -> str:
+        return TRACKS.path(self.tracks[index])
+
+    def paths(self):
+        return map(TRACKS.path, self.tracks)
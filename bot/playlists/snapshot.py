@@ -0,0 +1,65 @@
+from .common import Playlist, TRACKS
+from array import array
+import json
+import os
+
+SNAPSHOT_VERSION = 1
+
+# Every source's playlists from the last successful load, so the bot has
+# something to offer right after a restart while the sources are loaded again.
+#
+# Track paths are stored once and playlists refer to them by position, the same
+# way they refer to TRACKS in memory.
+
+def save(path: str, playlists_by_source: dict[str, list[Playlist]]) -> None:
+    positions: dict[int, int] = {}
+    tracks: list[str] = []
+
+    def position(id: int) -> int:
+        if id not in positions:
+            positions[id] = len(tracks)
+            tracks.append(TRACKS.path(id))
+        return positions[id]
+
+    sources = {
+        source: [
+            {
+                "name": playlist.name,
+                "source": playlist.source,
+                "tracks": [ position(id) for id in playlist.tracks ]
+            }
+            for playlist in loaded
+        ]
+        for source, loaded in playlists_by_source.items()
+    }
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "tracks": tracks,
+        "sources": sources
+    }
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(snapshot, file)
+    os.replace(temp_path, path)
+
+def load(path: str) -> dict[str, list[Playlist]]:
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "rb") as file:
+        snapshot = json.load(file)
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return {}
+
+    ids = [ TRACKS.intern(track) for track in snapshot["tracks"] ]
+
+    return {
+        source: [
+            Playlist(playlist["name"], playlist["source"], array("I", (ids[i] for i in playlist["tracks"])))
+            for playlist in loaded
+        ]
+        for source, loaded in snapshot["sources"].items()
+    }
@@ -1,25 +1,78 @@
-from .common import Playlist
-from bs4 import BeautifulSoup
+from .common import Playlist, track_ids
+import concurrent.futures
+import dataclasses
 import os
 import pathlib
 import urllib.parse
+import xml.etree.ElementTree as ET
+
+MAX_WORKERS = 4
+
+@dataclasses.dataclass
+class XSPFTrack:
+    locations: list[str]
+    title: (str | None) = None
+    creator: (str | None) = None
+    duration: (float | None) = None
+
+def _local_name(tag: str) -> str:
+    # Drop the "{http://xspf.org/ns/0/}" namespace prefix
+    return tag.rpartition("}")[2]
+
+def iter_tracks(path: str):
+    # Streams <track> elements one at a time instead of building the whole
+    # document, every finished track is dropped from the tree again
+    track_list: (ET.Element | None) = None
+    track: (XSPFTrack | None) = None
+
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        name = _local_name(element.tag)
+
+        if event == "start":
+            if name == "trackList":
+                track_list = element
+            elif name == "track":
+                track = XSPFTrack([])
+            continue
+
+        if track is None:
+            continue
+
+        if name == "location" and element.text is not None:
+            track.locations.append(urllib.parse.unquote(element.text))
+        elif name == "title":
+            track.title = element.text
+        elif name == "creator":
+            track.creator = element.text
+        elif name == "duration" and element.text is not None:
+            try:
+                track.duration = int(element.text) / 1000
+            except ValueError:
+                pass
+        elif name == "track":
+            yield track
+            track = None
+            if track_list is not None:
+                track_list.clear()
 
 def parse(path: str) -> Playlist:
     name = pathlib.Path(path).stem
-    tracks: list[str] = []
-
-    file = open(path, "rb")
-    data = file.read()
-    file.close()
+    return Playlist(name, path, track_ids(
+        location for track in iter_tracks(path) for location in track.locations
+    ))
 
-    bs = BeautifulSoup(data, "xml")
-    for tag in bs.find_all("location"):
-        tracks.append(urllib.parse.unquote(tag.text))
+def _try_parse(path: str) -> (Playlist | None):
+    try:
+        return parse(path)
+    except (OSError, ET.ParseError) as e:
+        print(f"Couldn't parse {path}: {e}")
+        return None
 
-    return Playlist(name, path, tracks)
+# path -> ((mtime, size), playlist) from the last time the file was parsed
+_cache: dict[str, tuple[tuple[int, int], Playlist]] = {}
 
 def find_and_parse(folder: str) -> list[Playlist]:
-    playlists: list[Playlist] = []
+    signatures: dict[str, tuple[int, int]] = {}
 
     for file in os.listdir(folder):
         path = os.path.join(folder, file)
@@ -29,6 +82,21 @@ def find_and_parse(folder: str) -> list[Playlist]:
         if not path.endswith(".xspf"):
             continue
 
-        playlists.append(parse(path))
+        stat = os.stat(path)
+        signatures[path] = (stat.st_mtime_ns, stat.st_size)
+
+    changed = [
+        path for path, signature in signatures.items()
+        if path not in _cache or _cache[path][0] != signature
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="xspf") as executor:
+        for path, playlist in zip(changed, executor.map(_try_parse, changed)):
+            if playlist is not None:
+                _cache[path] = (signatures[path], playlist)
+
+    for path in list(_cache.keys()):
+        if path not in signatures:
+            del _cache[path]
 
-    return playlists
+    return [ _cache[path][1] for path in signatures if path in _cache ]
@@ -1,15 +1,39 @@
-from config import *
+from settings import *
 import lastfm
+import metadata
 import music_bot
+import player
 import commands
+import scrobbler
+import transcode
 
 if __name__ == "__main__":
+    lfm = lastfm.LastFM(LASTFM_API_KEY, LASTFM_SECRET)
+    lfmsm = lastfm.LastFMSessionManager(LASTFM_SESSIONS_FILE)
+
     bot = music_bot.MusicBot(
-        lastfm.LastFM(LASTFM_API_KEY, LASTFM_SECRET),
-        lastfm.LastFMSessionManager(LASTFM_SESSIONS_FILE)
+        lfm,
+        lfmsm,
+        scrobbler.ScrobbleDispatcher(lfm, lfmsm, SCROBBLE_QUEUE_PATH, SCROBBLE_CONCURRENCY, SCROBBLE_RATE),
+        metadata.MetadataStore(METADATA_DB_PATH),
+        None if TRANSCODE_CACHE_PATH is None else transcode.TranscodeCache(
+            TRANSCODE_CACHE_PATH,
+            TRANSCODE_CACHE_SIZE,
+            player.Player.BITRATE,
+            TRANSCODE_WORKERS
+        ),
+        None if DOWNLOAD_CACHE_PATH is None else transcode.TranscodeCache(
+            DOWNLOAD_CACHE_PATH,
+            DOWNLOAD_CACHE_SIZE,
+            player.Player.BITRATE,
+            DOWNLOAD_WORKERS
+        )
     )
 
     for group in commands.GROUPS:
         bot.tree.add_command(group)
 
+    for command in commands.COMMANDS:
+        bot.tree.add_command(command)
+
     bot.run(DISCORD_TOKEN)
@@ -0,0 +1,287 @@
+from metadata import Metadata
+from typing import Callable
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import itertools
+import lastfm
+import metrics
+import sqlite3
+import time
+
+SENT = metrics.Counter("scrobbler_sent_total", "Scrobbles and now playing updates accepted by last.fm", ("kind", ))
+FAILED = metrics.Counter("scrobbler_failed_total", "Scrobbles and now playing updates that failed to send", ("kind", ))
+PENDING = metrics.Gauge("scrobbler_pending", "Scrobbles waiting to be sent")
+SUPPRESSED = metrics.Gauge("scrobbler_suppressed", "last.fm calls that were avoided", ("reason", ))
+
+@dataclasses.dataclass
+class NowPlaying:
+    metadata: Metadata
+    queued_at: float
+    is_listening: (Callable[[], bool] | None) = None
+
+# Spaces out requests so they never go above `rate` per second on average
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next: float = 0
+
+    async def wait(self) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        at = max(now, self._next)
+        self._next = at + self.interval
+        await asyncio.sleep(at - now)
+
+# Sends scrobbles and now playing updates to last.fm.
+#
+# Pending scrobbles are kept in a SQLite file until last.fm accepted them, so
+# nothing is lost on a crash or restart. They're sent in batches of up to 50
+# per user, different users are sent concurrently within the rate limit, and
+# failed batches are retried with exponential backoff.
+#
+# Now playing updates are debounced per user: only the latest one is sent,
+# and only once it's been current for NOW_PLAYING_DEBOUNCE seconds, so rapid
+# skips don't turn into bursts of requests that are stale right away.
+class ScrobbleDispatcher:
+    MAX_ATTEMPTS: int = 10
+    MAX_BACKOFF: float = 60 * 60
+    NOW_PLAYING_DEBOUNCE: float = 3
+
+    def __init__(self, lfm: lastfm.LastFM, lfmsm: lastfm.LastFMSessionManager, queue_path: str, concurrency: int = 4, rate: float = 5):
+        self.lfm = lfm
+        self.lfmsm = lfmsm
+        self.queue_path = queue_path
+
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiter = RateLimiter(rate)
+        self._wakeup = asyncio.Event()
+        self._now_playing: dict[str, NowPlaying] = {}
+        # The loop only keeps weak references to tasks, these would otherwise
+        # be collected before the scrobble is stored
+        self._inserts: set[asyncio.Task] = set()
+
+        # Requests we didn't have to make, by reason
+        self.suppressed: collections.Counter[str] = collections.Counter()
+
+        PENDING.callback = lambda: self.pending
+        SUPPRESSED.callback = lambda: { (reason, ): count for reason, count in self.suppressed.items() }
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="scrobbles")
+        self._connection = sqlite3.connect(queue_path, check_same_thread=False)
+        self._connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS pending (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                track TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                album TEXT,
+                album_artist TEXT,
+                timestamp INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0
+            );
+        """)
+
+        self.pending: int = self._connection.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _insert(self, user_id: str, metadata: Metadata, timestamp: int) -> None:
+        self._connection.execute(
+            "INSERT INTO pending (user_id, track, artist, album, album_artist, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, metadata.title, metadata.artist, metadata.album, metadata.album_artist, timestamp)
+        )
+        self._connection.commit()
+
+    def _due(self) -> list[tuple]:
+        return self._connection.execute(
+            "SELECT id, user_id, track, artist, album, album_artist, timestamp, attempts FROM pending WHERE next_attempt <= ? ORDER BY user_id, id",
+            (time.time(), )
+        ).fetchall()
+
+    def _next_due(self) -> (float | None):
+        next_attempt, = self._connection.execute("SELECT MIN(next_attempt) FROM pending").fetchone()
+        return next_attempt
+
+    def _delete(self, ids: list[int]) -> None:
+        self._connection.executemany("DELETE FROM pending WHERE id = ?", ((id, ) for id in ids))
+        self._connection.commit()
+
+    def _retry_later(self, rows: list[tuple]) -> int:
+        # Returns how many scrobbles were given up on
+        dropped = 0
+        now = time.time()
+        for id, *_, attempts in rows:
+            if attempts + 1 >= ScrobbleDispatcher.MAX_ATTEMPTS:
+                print(f"Giving up on scrobble {id} after {attempts + 1} attempts")
+                self._connection.execute("DELETE FROM pending WHERE id = ?", (id, ))
+                dropped += 1
+                continue
+
+            backoff = min(ScrobbleDispatcher.MAX_BACKOFF, 5 * 2 ** attempts)
+            self._connection.execute(
+                "UPDATE pending SET attempts = ?, next_attempt = ? WHERE id = ?",
+                (attempts + 1, now + backoff, id)
+            )
+        self._connection.commit()
+        return dropped
+
+    def _can_scrobble(self, user_id: str, metadata: Metadata) -> bool:
+        if self.lfmsm.get_session(user_id) is None:
+            self.suppressed["no_session"] += 1
+            return False
+
+        if metadata.artist is None or metadata.title is None:
+            print(f"Not scrobbling for {user_id} because there's not artist or title field")
+            self.suppressed["no_tags"] += 1
+            return False
+
+        return True
+
+    def scrobble(self, user_id: str, metadata: Metadata, timestamp: (int | None) = None) -> None:
+        if not self._can_scrobble(user_id, metadata):
+            return
+
+        async def insert():
+            await self._run(self._insert, user_id, metadata, int(time.time()) if timestamp is None else timestamp)
+            self.pending += 1
+            self._wakeup.set()
+
+        task = asyncio.get_running_loop().create_task(insert())
+        self._inserts.add(task)
+        task.add_done_callback(self._inserts.discard)
+
+    def now_playing(self, user_id: str, metadata: Metadata, is_listening: (Callable[[], bool] | None) = None) -> None:
+        # Not persisted, a now playing update is useless by the time we'd retry it
+        if not self._can_scrobble(user_id, metadata):
+            return
+
+        if user_id in self._now_playing:
+            self.suppressed["superseded"] += 1
+
+        self._now_playing[user_id] = NowPlaying(metadata, asyncio.get_running_loop().time(), is_listening)
+        self._wakeup.set()
+
+    async def _request(self, call, *args, **kwargs):
+        async with self._semaphore:
+            await self._limiter.wait()
+            return await call(*args, **kwargs)
+
+    async def _send_now_playing(self, user_id: str, job: NowPlaying) -> None:
+        if job.is_listening is not None and not job.is_listening():
+            self.suppressed["not_listening"] += 1
+            return
+
+        session = self.lfmsm.get_session(user_id)
+        if session is None:
+            return
+
+        name, session_key = session
+        metadata = job.metadata
+        assert metadata.title is not None and metadata.artist is not None
+
+        print(f"Updating now playing to {metadata} for {name}")
+        try:
+            await self._request(
+                self.lfm.track_update_now_playing,
+                track=metadata.title,
+                artist=metadata.artist,
+                album=metadata.album,
+                album_artist=(
+                    metadata.artist
+                    if metadata.album_artist is None else
+                    metadata.album_artist
+                ),
+                session_key=session_key
+            )
+        except Exception as e:
+            print(f"Couldn't update now playing for {name}: {e}")
+            FAILED.inc("now_playing")
+            return
+
+        SENT.inc("now_playing")
+
+    async def _send_scrobbles(self, user_id: str, rows: list[tuple]) -> None:
+        session = self.lfmsm.get_session(user_id)
+        if session is None:
+            print(f"Couldn't find last.fm session key for {user_id}, dropping {len(rows)} scrobble(s)")
+            await self._run(self._delete, [ row[0] for row in rows ])
+            self.pending -= len(rows)
+            return
+
+        name, session_key = session
+
+        for i in range(0, len(rows), lastfm.LastFM.SCROBBLE_BATCH_SIZE):
+            batch = rows[i:i + lastfm.LastFM.SCROBBLE_BATCH_SIZE]
+            scrobbles = [
+                {
+                    "track": track,
+                    "artist": artist,
+                    "album": album,
+                    "albumArtist": artist if album_artist is None else album_artist,
+                    "timestamp": timestamp
+                }
+                for _, _, track, artist, album, album_artist, timestamp, _ in batch
+            ]
+
+            print(f"Scrobbling {len(batch)} track(s) for {name}")
+            try:
+                await self._request(self.lfm.track_scrobble_batch, scrobbles, session_key)
+            except Exception as e:
+                print(f"Couldn't scrobble for {name}, will retry: {e}")
+                self.pending -= await self._run(self._retry_later, batch)
+                FAILED.inc("scrobble", amount=len(batch))
+                continue
+
+            await self._run(self._delete, [ row[0] for row in batch ])
+            self.pending -= len(batch)
+            SENT.inc("scrobble", amount=len(batch))
+
+    def _due_now_playing(self) -> dict[str, NowPlaying]:
+        cutoff = asyncio.get_running_loop().time() - ScrobbleDispatcher.NOW_PLAYING_DEBOUNCE
+        due = { user_id: job for user_id, job in self._now_playing.items() if job.queued_at <= cutoff }
+        for user_id in due:
+            del self._now_playing[user_id]
+        return due
+
+    async def _drain(self) -> None:
+        now_playing = self._due_now_playing()
+        due = await self._run(self._due)
+
+        await asyncio.gather(
+            *[ self._send_now_playing(user_id, job) for user_id, job in now_playing.items() ],
+            *[
+                self._send_scrobbles(user_id, list(rows))
+                for user_id, rows in itertools.groupby(due, key=lambda row: row[1])
+            ]
+        )
+
+    async def run(self) -> None:
+        while True:
+            self._wakeup.clear()
+
+            try:
+                await self._drain()
+            except Exception as e:
+                print(f"Scrobble dispatcher error: {e}")
+
+            timeouts: list[float] = []
+
+            next_due = await self._run(self._next_due)
+            if next_due is not None:
+                timeouts.append(max(1, next_due - time.time()))
+
+            if len(self._now_playing) > 0:
+                oldest = min(job.queued_at for job in self._now_playing.values())
+                timeouts.append(max(0, oldest + ScrobbleDispatcher.NOW_PLAYING_DEBOUNCE - asyncio.get_running_loop().time()))
+
+            timeout = min(timeouts) if len(timeouts) > 0 else None
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
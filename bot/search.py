@@ -0,0 +1,192 @@
+from array import array
+from metadata import Metadata
+import asyncio
+import dataclasses
+import heapq
+import itertools
+import os
+import re
+
+@dataclasses.dataclass
+class Entry:
+    key: str
+    display: str
+    # Normalized display text, padded with spaces so word boundaries are part
+    # of the trigrams
+    text: str
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.casefold()))
+
+def _grams(padded: str) -> set[str]:
+    grams = { padded[i:i + 3] for i in range(len(padded) - 2) }
+
+    # Word starts, so single character queries still have something to match
+    grams.update(" " + word[0] for word in padded.split())
+
+    return grams
+
+def _query_grams(query: str) -> set[str]:
+    # Only padded at the start, the last word being typed is matched as a prefix
+    padded = f" {query}"
+    if len(padded) < 3:
+        return { padded }
+    return { padded[i:i + 3] for i in range(len(padded) - 2) }
+
+def describe_track(track: str, metadata: (Metadata | None)) -> str:
+    if metadata is None or metadata.title is None:
+        return os.path.splitext(os.path.basename(track))[0]
+
+    return " - ".join(field for field in (metadata.title, metadata.artist, metadata.album) if field)
+
+# Trigram index with ranked fuzzy matching.
+#
+# Candidates come from the posting lists of the rarest query trigrams, so a
+# lookup only ever looks at a small slice of the index, and are ranked by how
+# many of the query's trigrams they contain. Removed entries are left as
+# tombstones and the index is compacted once they outnumber the live ones.
+class SearchIndex:
+    MAX_CANDIDATES: int = 250
+    # IDs of the rarest posting list looked at for exact matches
+    MAX_EXACT_SCAN: int = 2000
+    MIN_SCORE: float = 0.5
+    UPDATE_CHUNK_SIZE: int = 250
+
+    def __init__(self):
+        self._entries: list[(Entry | None)] = []
+        self._ids: dict[str, int] = {}
+        self._postings: dict[str, array] = {}
+        self._dead: int = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _add(self, key: str, display: str) -> None:
+        entry = Entry(key, display, f" {normalize(display)} ")
+        id = len(self._entries)
+        self._entries.append(entry)
+        self._ids[key] = id
+
+        postings = self._postings
+        for gram in _grams(entry.text):
+            posting = postings.get(gram)
+            if posting is None:
+                posting = postings[gram] = array("I")
+            posting.append(id)
+
+    def _remove(self, key: str) -> None:
+        id = self._ids.pop(key, None)
+        if id is None:
+            return
+
+        self._entries[id] = None
+        self._dead += 1
+
+    def _set(self, key: str, display: str) -> None:
+        id = self._ids.get(key)
+        if id is not None:
+            entry = self._entries[id]
+            if entry is not None and entry.display == display:
+                return
+            self._remove(key)
+
+        self._add(key, display)
+
+    def _compact(self) -> None:
+        if self._dead <= len(self._ids):
+            return
+
+        live = [ entry for entry in self._entries if entry is not None ]
+        self._entries = []
+        self._ids = {}
+        self._postings = {}
+        self._dead = 0
+
+        for entry in live:
+            self._add(entry.key, entry.display)
+
+    def update(self, entries: dict[str, str]) -> None:
+        # Makes the index contain exactly `entries` (key -> display text),
+        # touching only what changed
+        for key in [ key for key in self._ids if key not in entries ]:
+            self._remove(key)
+
+        for key, display in entries.items():
+            self._set(key, display)
+
+        self._compact()
+
+    async def update_async(self, entries: dict[str, str]) -> None:
+        # Same as update but gives the event loop a chance to run in between
+        # chunks, for big indexes like the track one
+        for key in [ key for key in self._ids if key not in entries ]:
+            self._remove(key)
+
+        items = list(entries.items())
+        for i in range(0, len(items), SearchIndex.UPDATE_CHUNK_SIZE):
+            for key, display in items[i:i + SearchIndex.UPDATE_CHUNK_SIZE]:
+                self._set(key, display)
+            await asyncio.sleep(0)
+
+        self._compact()
+
+    def get(self, key: str) -> (Entry | None):
+        id = self._ids.get(key)
+        return None if id is None else self._entries[id]
+
+    def search(self, query: str, limit: int = 25) -> list[Entry]:
+        query = normalize(query)
+        if len(query) == 0:
+            return []
+
+        grams = _query_grams(query)
+        postings = sorted((self._postings[gram] for gram in grams if gram in self._postings), key=len)
+        if len(postings) == 0:
+            return []
+
+        # Anything containing the query as typed has every one of its trigrams,
+        # so there's none if one isn't in the index at all, and otherwise it's
+        # in the rarest posting list, which is usually tiny. If that gives
+        # enough results there's no need for fuzzy matching at all.
+        needle = f" {query}"
+        exact: list[Entry] = []
+        if len(postings) == len(grams):
+            for id in itertools.islice(postings[0], SearchIndex.MAX_EXACT_SCAN):
+                entry = self._entries[id]
+                if entry is not None and needle in entry.text:
+                    exact.append(entry)
+                    if len(exact) >= limit * 4:
+                        break
+
+        if len(exact) >= limit:
+            exact.sort(key=lambda entry: (not entry.text.startswith(needle), len(entry.text)))
+            return exact[:limit]
+
+        # Exact matches are always scored, they get the highest scores anyway.
+        # The rest come from the rarest two posting lists, so one typo doesn't
+        # rule out a match.
+        candidates: set[int] = { self._ids[entry.key] for entry in exact }
+        for posting in postings[:2]:
+            candidates.update(posting[:SearchIndex.MAX_CANDIDATES])
+
+        scored: list[tuple[float, Entry]] = []
+        for id in candidates:
+            entry = self._entries[id]
+            if entry is None:
+                continue
+
+            text = entry.text
+            score = sum(map(text.__contains__, grams)) / len(grams)
+            if score < SearchIndex.MIN_SCORE:
+                continue
+
+            if needle in text:
+                score += 0.5
+                if text.startswith(needle):
+                    score += 0.25
+
+            # Prefer shorter matches when everything else is equal
+            score -= len(text) / 10000
+            scored.append((score, entry))
+
+        return [ entry for _, entry in heapq.nlargest(limit, scored, key=lambda item: item[0]) ]
@@ -0,0 +1,152 @@
+from array import array
+from playlists.common import Playlist
+import abc
+import collections
+import random
+
+# Track selection strategies. Every pick is constant time no matter how big the
+# playlist is, and returns a track ID (see playlists.common.TRACKS).
+#
+# Selectors notice when a reload swaps out their playlist's tracks and start
+# over with the new ones.
+class Selector(abc.ABC):
+    def __init__(self, playlist: Playlist):
+        self.playlist = playlist
+        self._tracks: (array | None) = None
+
+    def _reset(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _pick(self) -> int:
+        # Index into self._tracks
+        ...
+
+    def pick(self) -> int:
+        if self.playlist.tracks is not self._tracks:
+            self._tracks = self.playlist.tracks
+            if len(self._tracks) == 0:
+                raise IndexError("Cannot pick from an empty playlist")
+            self._reset()
+
+        return self._tracks[self._pick()]
+
+# Random with replacement, the same track can come up again right away
+class RandomSelector(Selector):
+    def _pick(self) -> int:
+        assert self._tracks is not None
+        return random.randrange(len(self._tracks))
+
+# Every track once before any repeats. A Fisher-Yates shuffle done one step at
+# a time, positions that were swapped are kept in a dict so the playlist never
+# has to be copied.
+class ShuffleSelector(Selector):
+    def _reset(self) -> None:
+        assert self._tracks is not None
+        self._remaining = len(self._tracks)
+        self._swapped: dict[int, int] = {}
+
+    def _pick(self) -> int:
+        if self._remaining == 0:
+            self._reset()
+
+        i = random.randrange(self._remaining)
+        last = self._remaining - 1
+
+        picked = self._swapped.get(i, i)
+        self._swapped[i] = self._swapped.pop(last, last)
+        self._remaining -= 1
+
+        if i == last:
+            self._swapped.pop(i, None)
+
+        return picked
+
+# Random, but never one of the last `window` tracks
+class HistorySelector(Selector):
+    MAX_ATTEMPTS: int = 32
+
+    def __init__(self, playlist: Playlist, window: int = 50):
+        super().__init__(playlist)
+        self.window = window
+
+    def _reset(self) -> None:
+        assert self._tracks is not None
+        # At most half the playlist, otherwise finding a track that's allowed
+        # takes more and more attempts
+        self._recent: collections.deque[int] = collections.deque(maxlen=max(0, min(self.window, len(self._tracks) // 2)))
+        self._recent_set: set[int] = set()
+
+    def _pick(self) -> int:
+        assert self._tracks is not None
+
+        for _ in range(HistorySelector.MAX_ATTEMPTS):
+            i = random.randrange(len(self._tracks))
+            if self._tracks[i] not in self._recent_set:
+                break
+
+        if self._recent.maxlen == 0:
+            return i
+
+        if len(self._recent) == self._recent.maxlen:
+            self._recent_set.discard(self._recent[0])
+        self._recent.append(self._tracks[i])
+        self._recent_set.add(self._tracks[i])
+
+        return i
+
+# Random weighted by a per-track weight, using Walker's alias method so a pick
+# is one random number and one table lookup
+class WeightedSelector(Selector):
+    def __init__(self, playlist: Playlist, weights: dict[int, float], default: float = 1):
+        super().__init__(playlist)
+        self.weights = weights
+        self.default = default
+
+    def _reset(self) -> None:
+        assert self._tracks is not None
+        n = len(self._tracks)
+
+        weights = [ max(0, self.weights.get(id, self.default)) for id in self._tracks ]
+        total = sum(weights)
+        if total == 0:
+            weights = [ 1.0 ] * n
+            total = n
+
+        scaled = [ weight * n / total for weight in weights ]
+        self._probability = array("d", [ 0 ]) * n
+        self._alias = array("I", [ 0 ]) * n
+
+        small = [ i for i, p in enumerate(scaled) if p < 1 ]
+        large = [ i for i, p in enumerate(scaled) if p >= 1 ]
+
+        while len(small) > 0 and len(large) > 0:
+            s, l = small.pop(), large.pop()
+            self._probability[s] = scaled[s]
+            self._alias[s] = l
+
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+
+        for i in small + large:
+            self._probability[i] = 1
+
+    def _pick(self) -> int:
+        i = random.randrange(len(self._probability))
+        return i if random.random() < self._probability[i] else self._alias[i]
+
+MODES = ["shuffle", "random", "history", "playcount", "rating"]
+
+def create(mode: str, playlist: Playlist, stats: dict[int, tuple[int, float]]) -> Selector:
+    # `stats` is track ID -> (play count, rating from 0 to 1 or -1 if unrated)
+    if mode == "random":
+        return RandomSelector(playlist)
+    if mode == "history":
+        return HistorySelector(playlist)
+    if mode == "playcount":
+        return WeightedSelector(playlist, { id: 1 + playcount for id, (playcount, _) in stats.items() })
+    if mode == "rating":
+        # Unrated tracks count as average, zero stars still get played once in a while
+        return WeightedSelector(playlist, { id: 0.5 if rating < 0 else max(0.05, rating) for id, (_, rating) in stats.items() }, default=0.5)
+
+    return ShuffleSelector(playlist)
@@ -0,0 +1,32 @@
+from config import *
+import config
+
+# Optional settings. These can be overridden in config.py but don't have to be,
+# so existing configs keep working.
+
+METADATA_DB_PATH: str = getattr(config, "METADATA_DB_PATH", "metadata.db")
+COLLECTION_SNAPSHOT_PATH: (str | None) = getattr(config, "COLLECTION_SNAPSHOT_PATH", "collection_snapshot.json")
+PLAYLIST_SNAPSHOT_PATH: (str | None) = getattr(config, "PLAYLIST_SNAPSHOT_PATH", "playlists_snapshot.json")
+COLLECTION_WATCH: bool = getattr(config, "COLLECTION_WATCH", False)
+TRANSCODE_CACHE_PATH: (str | None) = getattr(config, "TRANSCODE_CACHE_PATH", None)
+TRANSCODE_CACHE_SIZE: int = getattr(config, "TRANSCODE_CACHE_SIZE", 10 * 1024 ** 3)
+TRANSCODE_WORKERS: int = getattr(config, "TRANSCODE_WORKERS", 2)
+# Smaller copies of tracks too big to upload with /current download
+DOWNLOAD_CACHE_PATH: (str | None) = getattr(config, "DOWNLOAD_CACHE_PATH", "downloads")
+DOWNLOAD_CACHE_SIZE: int = getattr(config, "DOWNLOAD_CACHE_SIZE", 2 * 1024 ** 3)
+DOWNLOAD_WORKERS: int = getattr(config, "DOWNLOAD_WORKERS", 2)
+# Measures every track's loudness in the background and evens out volume
+# during playback
+LOUDNESS_NORMALIZATION: bool = getattr(config, "LOUDNESS_NORMALIZATION", False)
+LOUDNESS_TARGET: float = getattr(config, "LOUDNESS_TARGET", -18.0)
+LOUDNESS_WORKERS: int = getattr(config, "LOUDNESS_WORKERS", 1)
+SCROBBLE_QUEUE_PATH: str = getattr(config, "SCROBBLE_QUEUE_PATH", "scrobbles.db")
+SCROBBLE_CONCURRENCY: int = getattr(config, "SCROBBLE_CONCURRENCY", 4)
+SCROBBLE_RATE: float = getattr(config, "SCROBBLE_RATE", 5)
+SHUFFLE_MODE: str = getattr(config, "SHUFFLE_MODE", "shuffle")
+METRICS_HOST: str = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT: (int | None) = getattr(config, "METRICS_PORT", None)
+# Seconds the event loop can be blocked before the stall detector samples what's
+# blocking it, None turns it off
+STALL_THRESHOLD: (float | None) = getattr(config, "STALL_THRESHOLD", None)
+STALL_REPORT_PATH: str = getattr(config, "STALL_REPORT_PATH", "stalls.txt")
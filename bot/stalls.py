@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import linecache
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Finds out what is blocking the event loop.
+#
+# The loop bumps a heartbeat every few milliseconds. A watchdog thread checks
+# it, and while the heartbeat is late by more than `threshold` it samples the
+# stack of the loop's thread. Samples are attributed to the innermost frame in
+# the bot's own code (the call site to blame) and to the full stack, and a
+# report ranked by total stalled time is written to `report_path`.
+class StallDetector:
+    STACK_DEPTH: int = 12
+    REPORT_INTERVAL: float = 10
+    REPORT_TOP: int = 20
+
+    def __init__(self, threshold: float, report_path: str, sample_interval: float = 0.01):
+        self.threshold = threshold
+        self.report_path = report_path
+        self.sample_interval = sample_interval
+        self.heartbeat_interval = max(sample_interval, threshold / 4)
+
+        self.stalls: int = 0
+        self.longest: float = 0
+
+        self._root = os.path.dirname(os.path.abspath(__file__))
+        self._sites: collections.Counter[tuple[str, int, str]] = collections.Counter()
+        self._stacks: collections.Counter[tuple[tuple[str, int, str], ...]] = collections.Counter()
+        self._beat: float = time.monotonic()
+        self._loop: asyncio.AbstractEventLoop
+        self._thread_id: int = 0
+        self._last_report: float = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        # Has to be called from the loop's own thread
+        self._loop = loop
+        self._thread_id = threading.get_ident()
+        self._heartbeat()
+        threading.Thread(target=self._watch, name="stall-detector", daemon=True).start()
+        print(f"Watching for event loop stalls longer than {self.threshold * 1000:.0f}ms, reporting to {self.report_path}")
+
+    def _heartbeat(self) -> None:
+        self._beat = time.monotonic()
+        self._loop.call_later(self.heartbeat_interval, self._heartbeat)
+
+    def _sample(self, seconds: float) -> None:
+        frame = sys._current_frames().get(self._thread_id)
+        if frame is None:
+            return
+
+        stack = traceback.StackSummary.extract(traceback.walk_stack(frame), limit=StallDetector.STACK_DEPTH, lookup_lines=False)
+        frames = tuple((summary.filename, summary.lineno or 0, summary.name) for summary in stack)
+        self._stacks[frames] += seconds
+
+        # Walked innermost first, so the first frame in our own code is the one
+        # that made the blocking call
+        for site in frames:
+            if site[0].startswith(self._root):
+                self._sites[site] += seconds
+                break
+        else:
+            if len(frames) > 0:
+                self._sites[frames[0]] += seconds
+
+    def _watch(self) -> None:
+        stall_start: (float | None) = None
+        last_sample = time.monotonic()
+
+        while True:
+            time.sleep(self.sample_interval)
+            now = time.monotonic()
+            elapsed = now - last_sample
+            last_sample = now
+            late = now - self._beat - self.heartbeat_interval
+
+            if late < self.threshold:
+                if stall_start is not None:
+                    duration = now - stall_start + self.threshold
+                    self.longest = max(self.longest, duration)
+                    stall_start = None
+
+                    if now - self._last_report > StallDetector.REPORT_INTERVAL:
+                        self._last_report = now
+                        self.write_report()
+                continue
+
+            if stall_start is None:
+                stall_start = now
+                self.stalls += 1
+
+            # Each sample stands for the time since the previous one
+            self._sample(elapsed)
+
+    def _describe(self, site: tuple[str, int, str]) -> str:
+        filename, lineno, name = site
+        line = linecache.getline(filename, lineno).strip()
+        return f"{os.path.relpath(filename, self._root)}:{lineno} in {name}: {line}"
+
+    def write_report(self) -> None:
+        lines = [
+            f"{self.stalls} stall(s) over {self.threshold * 1000:.0f}ms, longest {self.longest * 1000:.0f}ms",
+            "",
+            "Call sites by time stalled:"
+        ]
+
+        for site, seconds in self._sites.most_common(StallDetector.REPORT_TOP):
+            lines.append(f"{seconds * 1000:8.0f}ms  {self._describe(site)}")
+
+        lines.append("")
+        lines.append("Stacks by time stalled:")
+
+        for stack, seconds in self._stacks.most_common(StallDetector.REPORT_TOP):
+            lines.append(f"{seconds * 1000:8.0f}ms")
+            for site in stack:
+                lines.append(f"    {self._describe(site)}")
+
+        temp_path = f"{self.report_path}.tmp"
+        with open(temp_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.report_path)
@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import hashlib
+import os
+
+# Keeps Ogg/Opus copies of tracks so playback can pass them straight through
+# instead of FFmpeg re-encoding the source every time it's played.
+#
+# Files are named after a hash of the source path, its mtime and size and the
+# bitrate and gain, so a changed source never matches a stale transcode. The cache is
+# bounded by size and evicts the least recently played files first, the file
+# mtimes are used to remember that order across restarts.
+#
+# Background requests use the cache's own bitrate, get can also make copies
+# at any other bitrate. A gain (in dB) is applied while encoding, so playing a
+# normalized copy costs nothing extra.
+class TranscodeCache:
+    def __init__(self, directory: str, max_bytes: int, bitrate: int, workers: int = 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bitrate = bitrate
+        self.workers = workers
+
+        self._entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self._size: int = 0
+        self._queue: asyncio.Queue[tuple[str, (float | None)]] = asyncio.Queue()
+        self._pending: set[tuple[str, (float | None)]] = set()
+
+        # At most `workers` FFmpeg processes at once, and only one per file
+        self._slots = asyncio.Semaphore(workers)
+        self._running: dict[str, asyncio.Task] = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        files: list[tuple[float, str, int]] = []
+        for item in os.scandir(self.directory):
+            if not item.name.endswith(".ogg"):
+                # Leftover from an interrupted transcode
+                if item.name.endswith(".tmp"):
+                    os.remove(item.path)
+                continue
+
+            stat = item.stat()
+            files.append((stat.st_mtime, item.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+
+    def _name(self, track: str, bitrate: (int | None) = None, gain: (float | None) = None) -> str:
+        stat = os.stat(track)
+        key = f"{track}\0{stat.st_mtime_ns}\0{stat.st_size}\0{self.bitrate if bitrate is None else bitrate}"
+        if gain is not None:
+            key += f"\0{gain}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + ".ogg"
+
+    def _evict(self) -> list[str]:
+        # Drops the least recently played entries until the cache fits again,
+        # the files are left to the caller to remove
+        evicted: list[str] = []
+        while self._size > self.max_bytes and len(self._entries) > 0:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            evicted.append(os.path.join(self.directory, name))
+        return evicted
+
+    @staticmethod
+    def _remove(paths: list[str]) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _store(temp_path: str, path: str) -> int:
+        os.replace(temp_path, path)
+        return os.path.getsize(path)
+
+    def _find(self, track: str, bitrate: (int | None), gain: (float | None)) -> tuple[str, bool]:
+        # Runs in a thread, everything that touches the filesystem for a lookup
+        # happens here. Returns the file name and whether a file the cache knew
+        # about turned out to be gone. Found files get their mtime bumped, that's
+        # what keeps them from being evicted after a restart.
+        name = self._name(track, bitrate, gain)
+        if name not in self._entries:
+            return name, False
+
+        try:
+            os.utime(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return name, True
+
+        return name, False
+
+    def _touch(self, name: str, missing: bool) -> (str | None):
+        # The entries are only ever changed on the event loop
+        if name not in self._entries:
+            return None
+
+        if missing:
+            self._size -= self._entries.pop(name)
+            return None
+
+        self._entries.move_to_end(name)
+        return os.path.join(self.directory, name)
+
+    async def lookup(self, track: str, gain: (float | None) = None) -> (str | None):
+        # Path of an existing transcode, never starts one
+        return self._touch(*await asyncio.to_thread(self._find, track, None, gain))
+
+    def request(self, track: str, gain: (float | None) = None) -> None:
+        # Queue a track to be transcoded in the background, if it isn't already
+        if (track, gain) in self._pending:
+            return
+
+        self._pending.add((track, gain))
+        self._queue.put_nowait((track, gain))
+
+    async def _encode(self, track: str, name: str, bitrate: int, gain: (float | None)) -> (str | None):
+        path = os.path.join(self.directory, name)
+        temp_path = f"{path}.tmp"
+        filters = [] if gain is None else [ "-af", f"volume={gain}dB" ]
+
+        async with self._slots:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+                "-i", track,
+                # What FFmpegOpusAudio encodes to as well, the copies are sent to
+                # Discord as they are and it only plays stereo at 48kHz
+                "-map", "0:a:0", *filters, "-ac", "2", "-ar", "48000",
+                "-c:a", "libopus", "-b:a", f"{bitrate}k",
+                "-f", "ogg", temp_path,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            _, stderr = await process.communicate()
+
+        if process.returncode != 0:
+            print(f"Couldn't transcode {track}: {stderr.decode(errors='replace').strip()}")
+            await asyncio.to_thread(TranscodeCache._remove, [ temp_path ])
+            return None
+
+        size = await asyncio.to_thread(TranscodeCache._store, temp_path, path)
+        self._entries[name] = size
+        self._size += size
+        await asyncio.to_thread(TranscodeCache._remove, self._evict())
+        return path
+
+    async def get(self, track: str, bitrate: (int | None) = None, gain: (float | None) = None) -> (str | None):
+        # Path of a transcode at `bitrate` (the cache's own if None), made now if
+        # there isn't one yet. None if FFmpeg failed.
+        name, missing = await asyncio.to_thread(self._find, track, bitrate, gain)
+        path = self._touch(name, missing)
+        if path is not None:
+            return path
+
+        # Someone else asking for the same file waits for the same FFmpeg
+        if name not in self._running:
+            task = asyncio.get_running_loop().create_task(self._encode(track, name, self.bitrate if bitrate is None else bitrate, gain))
+            task.add_done_callback(lambda _: self._running.pop(name, None))
+            self._running[name] = task
+
+        return await asyncio.shield(self._running[name])
+
+    async def _worker(self) -> None:
+        while True:
+            track, gain = await self._queue.get()
+            try:
+                await self.get(track, gain=gain)
+            except Exception as e:
+                print(f"Couldn't transcode {track}: {e}")
+            finally:
+                self._pending.discard((track, gain))
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        for _ in range(self.workers):
+            loop.create_task(self._worker())
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import hashlib
+import os
+import sys
+import unittest
+from aiohttp import web
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+import lastfm
+import metrics
+
+USER_INFO = {
+    "user": {
+        "name": "someone",
+        "playcount": "12",
+        "artist_count": "3",
+        "track_count": "4",
+        "album_count": "5",
+        "image": [ { "#text": "small.png" }, { "#text": "large.png" } ],
+        "registered": { "unixtime": "1700000000" },
+        "url": "https://www.last.fm/user/someone"
+    }
+}
+
+# Stands in for the last.fm API: answers user.getinfo and track.scrobble,
+# remembers the parameters of every request and can be told to be slow or fail
+class StubLastFM:
+    def __init__(self):
+        self.requests: collections.Counter[str] = collections.Counter()
+        self.received: list[dict[str, str]] = []
+        self.delay: float = 0
+        self.status: int = 200
+        self._runner: web.AppRunner
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        params = dict(request.query) | dict(await request.post())
+        self.requests[params.get("method", "")] += 1
+        self.received.append(params)
+
+        await asyncio.sleep(self.delay)
+
+        if self.status != 200:
+            return web.json_response({ "error": 8, "message": "Operation failed" }, status=self.status)
+        if params.get("method") == "user.getinfo":
+            return web.json_response(USER_INFO)
+        if params.get("method") == "track.scrobble":
+            return web.json_response({ "scrobbles": { "@attr": { "accepted": 1, "ignored": 0 } } })
+
+        return web.json_response({ "error": 3, "message": "Invalid Method" }, status=400)
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_route("*", "/2.0/", self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+
+        return f"http://127.0.0.1:{self._runner.addresses[0][1]}/2.0/"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+class LastFMTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stub = StubLastFM()
+        url = await self.stub.start()
+
+        self.lfm = lastfm.LastFM("key", "secret", timeout=0.5)
+        # The counters are shared by every client, only what a test adds counts
+        self.errors_before = dict(lastfm.REQUEST_ERRORS.values)
+        with mock.patch.object(lastfm.LastFM, "API_ROOT", url):
+            self.lfm.init_session()
+
+    async def asyncTearDown(self):
+        await self.lfm._session.close()
+        await self.stub.stop()
+
+    def errors(self, method: str, error: (str | None) = None) -> float:
+        return sum(
+            value - self.errors_before.get(labels, 0)
+            for labels, value in lastfm.REQUEST_ERRORS.values.items()
+            if labels[0] == method and (error is None or labels[1] == error)
+        )
+
+    def test_prepare_leaves_params_alone(self):
+        params = { "user": "someone", "album": None }
+        prepared = self.lfm._prepare("user.getinfo", True, params)
+
+        self.assertEqual(params, { "user": "someone", "album": None })
+        self.assertNotIn("album", prepared)
+        self.assertEqual(prepared["method"], "user.getinfo")
+        self.assertIn("api_sig", prepared)
+
+    async def test_user_info_is_cached(self):
+        first = await self.lfm.user_get_info("someone")
+        second = await self.lfm.user_get_info("someone")
+
+        self.assertEqual(first, second)
+        self.assertEqual(first.image, "large.png")
+        self.assertEqual(self.stub.requests["user.getinfo"], 1)
+
+        # Other users aren't answered from the cache
+        await self.lfm.user_get_info("someone else")
+        self.assertEqual(self.stub.requests["user.getinfo"], 2)
+
+    async def test_user_info_cache_expires(self):
+        with mock.patch.object(lastfm.LastFM, "USER_INFO_TTL", 0.05):
+            await self.lfm.user_get_info("someone")
+            await asyncio.sleep(0.1)
+            await self.lfm.user_get_info("someone")
+
+        self.assertEqual(self.stub.requests["user.getinfo"], 2)
+
+    async def test_timeout_counts_as_error(self):
+        self.stub.delay = 1
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.lfm.user_get_info("someone")
+
+        self.assertEqual(self.errors("user.getinfo"), 1)
+
+    async def test_http_error_counts_as_error(self):
+        self.stub.status = 500
+
+        with self.assertRaises(lastfm.aiohttp.ClientResponseError):
+            await self.lfm.user_get_info("someone")
+
+        self.assertEqual(self.errors("user.getinfo"), 1)
+        self.assertEqual(self.errors("user.getinfo", "ClientResponseError"), 1)
+
+        # Failed responses aren't cached
+        self.stub.status = 200
+        await self.lfm.user_get_info("someone")
+        self.assertEqual(self.stub.requests["user.getinfo"], 2)
+
+    async def test_scrobble_batch_fields(self):
+        scrobbles = [
+            { "track": "First", "artist": "Artist", "album": "Album", "albumArtist": None, "timestamp": 1000 },
+            { "track": "Second", "artist": "Other", "album": None, "albumArtist": None, "timestamp": 2000 }
+        ]
+        await self.lfm.track_scrobble_batch(scrobbles, "session")
+
+        self.assertEqual(scrobbles[1]["album"], None)
+        self.assertEqual(len(self.stub.received), 1)
+        received = self.stub.received[0]
+
+        self.assertEqual(received["method"], "track.scrobble")
+        self.assertEqual(received["sk"], "session")
+        self.assertEqual(received["track[0]"], "First")
+        self.assertEqual(received["artist[0]"], "Artist")
+        self.assertEqual(received["album[0]"], "Album")
+        self.assertEqual(received["timestamp[0]"], "1000")
+        self.assertEqual(received["track[1]"], "Second")
+        self.assertEqual(received["artist[1]"], "Other")
+        self.assertEqual(received["timestamp[1]"], "2000")
+        # Missing values aren't sent at all
+        self.assertNotIn("album[1]", received)
+        self.assertNotIn("albumArtist[0]", received)
+
+        # Signed over exactly what arrived
+        signed = "".join(f"{key}{received[key]}" for key in sorted(received) if key not in ("api_sig", "format")) + "secret"
+        self.assertEqual(received["api_sig"], hashlib.md5(signed.encode("utf-8")).hexdigest())
+
+    def test_metrics_registered_once(self):
+        registered = len(metrics.REGISTRY)
+        lastfm.LastFM("key", "secret")
+        self.assertEqual(len(metrics.REGISTRY), registered)
+
+        names = [ metric.name for metric in metrics.REGISTRY ]
+        self.assertEqual(len(names), len(set(names)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bot"))
+
+import search
+
+class SearchIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.index = search.SearchIndex()
+        cls.index.update({ f"track{i}": f"Track {i}" for i in range(50000) })
+
+    def test_exact_match_first(self):
+        for query, expected in (("track 49999", "Track 49999"), ("49999", "Track 49999"), ("Track 12345", "Track 12345")):
+            self.assertEqual(self.index.search(query)[0].display, expected, query)
+
+    def test_exact_matches_before_fuzzy(self):
+        results = self.index.search("track 4999")
+        self.assertEqual([ entry.display for entry in results[:11] ], [ "Track 4999" ] + [ f"Track 4999{i}" for i in range(10) ])
+
+    def test_exact_match_behind_near_misses(self):
+        # More near misses than MAX_CANDIDATES, each with every trigram of the
+        # query but not the query itself, all indexed before the real match
+        index = search.SearchIndex()
+        index.update({ f"near{i}": f"Moon River Mars {i}" for i in range(search.SearchIndex.MAX_CANDIDATES + 50) } | { "exact": "River Moon" })
+
+        self.assertEqual(index.search("river moon")[0].display, "River Moon")
+        self.assertEqual(index.search("river moon", limit=1)[0].display, "River Moon")
+
+    def test_typo(self):
+        results = self.index.search("trakc 12345")
+        self.assertIn("Track 12345", [ entry.display for entry in results ])
+
+    def test_no_match(self):
+        self.assertEqual(self.index.search("zzz"), [])
+        self.assertEqual(self.index.search(""), [])
+
+if __name__ == "__main__":
+    unittest.main()